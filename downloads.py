@@ -0,0 +1,175 @@
+#
+# downloads.py -- schedule the big downloads (ZIP archives) of edna
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+import time
+import threading
+
+
+class Busy(Exception):
+  """Raised by DownloadScheduler.start() when a download can't start.
+  'position' is the place the download has in the queue, or None if it
+  wasn't queued at all."""
+  def __init__(self, reason, position=None):
+    Exception.__init__(self, reason)
+    self.reason = reason
+    self.position = position
+
+
+class DownloadScheduler:
+  """
+  Lets at most 'jobs' downloads run at the same time.  Others wait for
+  their turn, first come first served, in a queue of at most 'queue'
+  downloads; a client may have at most 'per_ip' downloads running or
+  waiting.  If 'rate' isn't 0, the downloads share that many bytes per
+  second between them (see take()).
+
+  start() is called before a download, and returns if it may run;
+  finish() is called after it, whatever happened.  Nothing waits in the
+  queue but a place: a download which can't run yet is turned away with
+  its position, and runs when the client asks for it again once its turn
+  has come.  A place the client hasn't asked for in 'hold' seconds is
+  given up.
+  """
+
+  def __init__(self, jobs, queue, per_ip, rate=0, hold=60):
+    self.jobs = jobs
+    self.queue_size = queue
+    self.per_ip = per_ip
+    self.hold = hold
+    self.lock = threading.Lock()
+    self.running = 0
+    self.waiting = [ ]          # the (ip, key) of the queued downloads
+    self.asked = { }            # (ip, key) -> when it was last asked for
+    self.clients = { }          # ip -> downloads running or waiting
+    self.bucket = None
+    if rate > 0:
+      self.bucket = TokenBucket(rate)
+
+  def start(self, ip, key):
+    """Let the download 'key' (its URL, say) of client 'ip' run, if it
+    may now.  Otherwise raises Busy, with the download's position if it
+    is (or stays) queued."""
+    self.lock.acquire()
+    try:
+      self._expire(time.time())
+      ticket = (ip, key)
+      if self.asked.has_key(ticket):
+        position = self.waiting.index(ticket) + 1
+        if position <= self.jobs - self.running:
+          # its turn has come
+          self.waiting.remove(ticket)
+          del self.asked[ticket]
+          self.running = self.running + 1
+          return
+        self.asked[ticket] = time.time()
+        raise Busy('it is waiting for its turn', position)
+      if self.per_ip and self.clients.get(ip, 0) >= self.per_ip:
+        raise Busy('too many downloads from %s' % ip)
+      if self.running < self.jobs and not self.waiting:
+        self.running = self.running + 1
+        self.clients[ip] = self.clients.get(ip, 0) + 1
+        return
+      if len(self.waiting) >= self.queue_size:
+        raise Busy('the download queue is full')
+      self.waiting.append(ticket)
+      self.asked[ticket] = time.time()
+      self.clients[ip] = self.clients.get(ip, 0) + 1
+      raise Busy('it is waiting for its turn', len(self.waiting))
+    finally:
+      self.lock.release()
+
+  def finish(self, ip):
+    self.lock.acquire()
+    try:
+      self._forget(ip)
+      self.running = self.running - 1
+    finally:
+      self.lock.release()
+
+  def queued(self):
+    return len(self.waiting)
+
+  def _expire(self, now):
+    "Give up the places in the queue no one asked for in time."
+    for ticket in self.waiting[:]:
+      if now - self.asked[ticket] > self.hold:
+        self.waiting.remove(ticket)
+        del self.asked[ticket]
+        self._forget(ticket[0])
+
+  def take(self, count):
+    """Wait until the downloads may send another 'count' bytes."""
+    if self.bucket is not None:
+      self.bucket.take(count)
+
+  def _forget(self, ip):
+    count = self.clients[ip] - 1
+    if count:
+      self.clients[ip] = count
+    else:
+      del self.clients[ip]
+
+
+class TokenBucket:
+  """
+  Limits a rate, in units (bytes) per second, shared by any number of
+  threads.  The bucket fills up at 'rate' tokens per second, up to one
+  second's worth; take() removes tokens from it, waiting for them if
+  there aren't enough.  Tokens can be owed: a big take() is allowed as
+  soon as the bucket isn't empty, and the ones after it wait longer.
+  """
+
+  def __init__(self, rate):
+    self.rate = float(rate)
+    self.tokens = self.rate
+    self.stamp = time.time()
+    self.lock = threading.Lock()
+
+  def take(self, count):
+    self.lock.acquire()
+    try:
+      now = time.time()
+      self.tokens = min(self.rate,
+                        self.tokens + (now - self.stamp) * self.rate)
+      self.stamp = now
+      # before we take ours, wait for whatever is owed to be paid back
+      delay = -self.tokens / self.rate
+      self.tokens = self.tokens - count
+    finally:
+      self.lock.release()
+    if delay > 0:
+      time.sleep(delay)
+
+
+class ThrottledFile:
+  """Passes the reads of file object 'f' through scheduler.take()."""
+
+  def __init__(self, f, scheduler):
+    self.f = f
+    self.scheduler = scheduler
+
+  def read(self, size):
+    data = self.f.read(size)
+    self.scheduler.take(len(data))
+    return data
+
+  def seek(self, pos):
+    self.f.seek(pos)
+
+  def close(self):
+    self.f.close()
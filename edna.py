@@ -43,11 +43,29 @@ import stat
 import random
 import time
 import struct
-import zipfile
+import threading
+import traceback
+import errno
+import select
+from types import ListType
 import ezt
 import MP3Info
 import md5
+import rfc822
 from scheduler import Scheduler
+from metacache import MetaCache, Indexer, _usable_file
+from searchindex import SearchIndex
+from filecache import FilenameCache, MTIME_SLACK
+from pagecache import PageCache, validators
+from playlist import PlaylistCache
+from downloads import DownloadScheduler, ThrottledFile, Busy
+from watcher import make_watcher
+import snapshot
+import sendfile
+import streamloop
+import zipstream
+from walker import Walker, list_dir, is_dir, join
+from threadpool import ThreadPoolMixIn
 try:
   import signal
   signalSupport = 'yes'
@@ -81,10 +99,21 @@ TITLE = 'Streaming MP3 Server'
 ### would be nice to get a bit fancier with the possible trimming
 re_trim = re.compile('[-0-9 ]*-[ ]*(.*)')
 
+# in pre-fork mode, how often (in seconds) the workers look for changes to
+# the filename cache snapshot and the metadata cache, and how often the
+# supervisor saves changes the watcher made to the filename cache
+SYNC_INTERVAL = 5
+SNAPSHOT_INTERVAL = 60
+
+# how often (in seconds) a client whose ZIP download is queued is asked
+# to try again, and how long its place is kept for it
+ZIP_RETRY = 10
+ZIP_HOLD = 60
+
 # determine which mixin to use: prefer threading, fall back to forking.
 try:
   import thread
-  mixin = SocketServer.ThreadingMixIn
+  mixin = ThreadPoolMixIn
 except ImportError:
   if not hasattr(os, 'fork'):
     print "ERROR: your platform does not support threading OR forking."
@@ -94,9 +123,15 @@ except ImportError:
 
 
 class Server(mixin, BaseHTTPServer.HTTPServer):
-  def __init__(self, fname):
+  def __init__(self, fname, previous=None):
+    """Set up a server from the config file 'fname'.  On a config reload,
+    'previous' is the server this one replaces; its listening socket, usage
+    logs and caches are taken over where the config allows it."""
     self.userLog = [ ] # to track server usage
     self.userIPs = { } # log unique IPs
+    if previous is not None:
+      self.userLog = previous.userLog
+      self.userIPs = previous.userIPs
 
     config = self.config = ConfigParser.ConfigParser()
 
@@ -104,6 +139,7 @@ class Server(mixin, BaseHTTPServer.HTTPServer):
     config.add_section('sources')
     config.add_section('acl')
     config.add_section('extra')
+    config.add_section('metadata_cache')
 
     # set up some defaults for the web server.
     d = config.defaults()
@@ -121,9 +157,35 @@ class Server(mixin, BaseHTTPServer.HTTPServer):
     d['encoding'] = 'UTF-8,iso8859-1'
     d['hide_names'] = ""
     d['hide_matching'] = ""
+    d['max_depth'] = '64'
+    d['max_entries'] = '0'
     d['zip'] = '0'
+    d['sendfile'] = '1'
+    d['keepalive_timeout'] = '15'
+    d['keepalive_max'] = '100'
+    d['threads'] = '64'
+    d['queue_size'] = '64'
+    d['max_streams'] = '0'
+    d['stream_loop'] = '0'
+    d['processes'] = '0'
+    d['shutdown_timeout'] = '30'
+    d['page_cache'] = '4'
+    d['resource_max_age'] = '604800'
+    d['zip_jobs'] = '4'
+    d['zip_queue'] = '16'
+    d['zip_per_ip'] = '2'
+    d['zip_rate'] = '0'
     d['refresh_offset'] = 0
     d['refresh_interval'] = 0
+    d['incremental'] = '0'
+    d['watch'] = '0'
+    d['watch_interval'] = '60'
+    d['snapshot_file'] = ''
+    d['cache_file'] = ''
+    d['index_offset'] = '-1'
+    d['index_interval'] = '-1'
+    d['index_workers'] = '1'
+    d['index_load'] = '0'
 
     config.read(fname)
 
@@ -144,8 +206,64 @@ class Server(mixin, BaseHTTPServer.HTTPServer):
     template_path = os.path.join(os.path.dirname(fname), template_path)
     self.resource_dir = os.path.join(os.path.dirname(fname), config.get('server', 'resource-dir'))
     self.fileinfo = config.getint('server', 'fileinfo')
+    self.metacache = None
+    self.indexer = None
+    self.metadata_index_scheduler = None
+    metacache_adopted = 0
+    cache_file = config.get('metadata_cache', 'cache_file')
     self.zipmax = config.getint('server', 'zip') * 1024 * 1024
-    self.zipsize = 0
+    # it holds the song information and the manifests of ZIP archives
+    if (self.fileinfo or self.zipmax > 0) and cache_file:
+      cache_file = os.path.join(os.path.dirname(fname), cache_file)
+      if previous is not None and previous.metacache is not None \
+         and previous.metacache.fname == cache_file:
+        self.metacache = previous.metacache
+        previous.metacache = None
+        metacache_adopted = 1
+      else:
+        try:
+          self.metacache = MetaCache(cache_file)
+          self.log_message("edna: Using metadata cache %s (%d entries)" %
+                           (cache_file, len(self.metacache)))
+        except (IOError, OSError), value:
+          self.log_message("WARNING: can't use the metadata cache %s: %s" %
+                           (cache_file, value))
+    self.zip_scheduler = DownloadScheduler(config.getint('server', 'zip_jobs'),
+                                           config.getint('server', 'zip_queue'),
+                                           config.getint('server', 'zip_per_ip'),
+                                           config.getint('server', 'zip_rate') * 1024,
+                                           ZIP_HOLD)
+    self.page_cache = None
+    page_cache = config.getint('server', 'page_cache')
+    if page_cache > 0:
+      self.page_cache = PageCache(page_cache * 1024 * 1024)
+    self.resource_max_age = config.getint('server', 'resource_max_age')
+    self.use_sendfile = sendfile.available \
+                        and config.getint('server', 'sendfile')
+    self.keepalive_timeout = config.getint('server', 'keepalive_timeout')
+    self.keepalive_max = config.getint('server', 'keepalive_max')
+    self.pool_threads = config.getint('server', 'threads')
+    self.pool_queue_size = config.getint('server', 'queue_size')
+    self.max_streams = config.getint('server', 'max_streams')
+    self.streams = 0
+    self.streams_lock = threading.Lock()
+    self.connections = 0        # accepted and not closed yet
+    self.idle_connections = { } # those waiting for their next request
+    self.connections_lock = threading.Lock()
+    self.draining = 0
+    self.shutdown_timeout = config.getint('server', 'shutdown_timeout')
+    self.stream_loop = None
+    self.use_stream_loop = config.getint('server', 'stream_loop')
+    if self.use_stream_loop and not streamloop.available:
+      self.log_message("WARNING: edna: stream_loop needs poll(), which "
+                       "this platform doesn't have")
+      self.use_stream_loop = 0
+    self.processes = config.getint('server', 'processes')
+    self.worker = 0     # set in the processes forked by run_prefork
+    self.next_sync = 0
+    # how deep and how far the walks through the source directories go
+    self.max_depth = config.getint('extra', 'max_depth')
+    self.max_entries = config.getint('extra', 'max_entries')
 
     global debug_level
     debug_level = config.getint('extra', 'debug_level')
@@ -243,53 +361,493 @@ class Server(mixin, BaseHTTPServer.HTTPServer):
     self.name_prefix = config.get('server', 'name_prefix')
 
     self.port = config.getint('server', 'port')
-    try:
-        SocketServer.TCPServer.__init__(self,
-            (config.get('server', 'binding-hostname'), self.port),
-            EdnaRequestHandler)
-    except socket.error, value:
-        self.log_message( "edna: bind(): %s" % str(value[1]) )
-        raise SystemExit
+    self.address = (config.get('server', 'binding-hostname'), self.port)
+    if previous is not None and previous.socket is not None \
+       and previous.address == self.address:
+      # take over the listening socket, so that no connection is refused
+      SocketServer.TCPServer.__init__(self, self.address, EdnaRequestHandler,
+                                      bind_and_activate=0)
+      self.socket.close()
+      self.socket = previous.socket
+      previous.socket = None
+      self.server_address = previous.server_address
+      self.server_name = previous.server_name
+      self.server_port = previous.server_port
+    else:
+      try:
+          SocketServer.TCPServer.__init__(self, self.address,
+              EdnaRequestHandler)
+      except socket.error, value:
+          self.log_message( "edna: bind(): %s" % str(value[1]) )
+          raise SystemExit
 
     # Check the configuration to see if we should be caching filenames.
     # If so, start up the scheduler.
     refresh_offset = config.getint('filename_cache', 'refresh_offset')
     refresh_interval = config.getint('filename_cache', 'refresh_interval')
     self.filename_cache = None
+    self.successor = None  # the server which took over on a reload
+    self.playlist_cache = None
+    self.search_index = None
     self.filename_cache_refresh_scheduler = None
+    self.filename_cache_watcher = None
+    self.snapshot_file = None
+    self.snapshot_mtime = None
     if (refresh_offset >= 0 and refresh_interval >= 0):
+      self.incremental_refresh = config.getint('filename_cache', 'incremental')
+      snapshot_file = config.get('filename_cache', 'snapshot_file')
+      if snapshot_file:
+        snapshot_file = os.path.join(os.path.dirname(fname), snapshot_file)
+      if previous is not None and previous.filename_cache is not None:
+        self.snapshot_file = snapshot_file
+        self.filename_cache_adopt(previous)
+      else:
+        self.filename_cache = FilenameCache()
+        self.filename_cache_lock = threading.Lock()
+        self.filename_cache_dirty = 0
+        # Start out with the cache saved by the last refresh, so searches
+        # work right away; the first refresh brings it up to date.
+        if snapshot_file:
+          self.snapshot_file = snapshot_file
+          self.filename_cache_load()
+      # the recursive playlists are made from it
+      self.playlist_cache = PlaylistCache(extensions)
       self.log_message("edna: Scheduling filename cache refresh for every " + self.hms(refresh_interval) + " after " + self.hms(refresh_offset))
-      self.filename_cache_refresh_scheduler = Scheduler(refresh_offset, refresh_interval, Server.filename_cache_refresh, [self], sleep_quantum=10)
+      # an adopted cache is current; don't walk everything again right away
+      self.filename_cache_refresh_scheduler = Scheduler(refresh_offset, refresh_interval, Server.filename_cache_refresh, [self], sleep_quantum=10, run_now=previous is None)
       self.filename_cache_refresh_scheduler.start()
 
+      # Apply changes to the cache as they happen, between refreshes
+      if config.getint('filename_cache', 'watch'):
+        self.filename_cache_watcher = make_watcher(self.filename_cache,
+          self.filename_cache_update,
+          config.getint('filename_cache', 'watch_interval'), self.log_message)
+        self.filename_cache_watcher.start()
+
+      if self.processes > 1 and not self.snapshot_file:
+        self.log_message("WARNING: with several processes and no snapshot_file, "
+                         "the workers never see the filename cache refreshes")
+
+    # Pre-parse the songs into the metadata cache in the background, so
+    # the first listing of a directory doesn't have to.
+    index_offset = config.getint('metadata_cache', 'index_offset')
+    index_interval = config.getint('metadata_cache', 'index_interval')
+    if self.fileinfo and self.metacache is not None and index_offset >= 0 \
+       and index_interval > 0:
+      # an adopted cache is already indexed, unless sources were added
+      run_now = not metacache_adopted
+      for dir in self.dirs:
+        if previous is not None and dir not in previous.dirs:
+          run_now = 1
+      self.indexer = Indexer(self.metacache, FileInfo,
+                             config.getint('metadata_cache', 'index_workers'),
+                             config.getfloat('metadata_cache', 'index_load'),
+                             self.log_message, self.max_depth,
+                             self.max_entries)
+      self.log_message("edna: Scheduling metadata indexing for every " + self.hms(index_interval) + " after " + self.hms(index_offset))
+      self.metadata_index_scheduler = Scheduler(index_offset, index_interval, Server.metadata_index, [self], sleep_quantum=10, run_now=run_now)
+      self.metadata_index_scheduler.start()
+
+  def start_workers(self):
+    """Start the threads which handle requests.  Called by the process
+    which serves them, once it is set up."""
+    if mixin is ThreadPoolMixIn:
+      self.start_pool()
+    if self.use_stream_loop:
+      self.stream_loop = streamloop.StreamLoop(self.log_message)
+      self.stream_loop.start()
+
+  def after_fork(self):
+    """Prepare the server for a worker process forked by run_prefork.  The
+    cache refresh and indexing threads stay in the supervisor; locks they
+    may have held at the time of the fork are replaced."""
+    self.worker = 1
+    self.filename_cache_dirty = 0
+    # load the snapshot again, shared with the other workers, rather than
+    # keep the supervisor's copy
+    self.snapshot_mtime = None
+    self.next_sync = 0
+    self.filename_cache_refresh_scheduler = None
+    self.filename_cache_watcher = None
+    self.metadata_index_scheduler = None
+    self.filename_cache_lock = threading.Lock()
+    self.streams_lock = threading.Lock()
+    self.connections_lock = threading.Lock()
+    if self.metacache is not None:
+      self.metacache.lock = threading.Lock()
+
+  def sync_caches(self):
+    """In a worker process, pick up the snapshot and the metadata cache
+    records the supervisor wrote since we last looked.  Looks at most once
+    every SYNC_INTERVAL seconds."""
+    now = time.time()
+    if now < self.next_sync:
+      return
+    self.next_sync = now + SYNC_INTERVAL
+    if self.snapshot_file:
+      mtime = _mtime(self.snapshot_file)
+      if mtime is not None and mtime != self.snapshot_mtime:
+        self.filename_cache_load()
+    if self.metacache is not None:
+      self.metacache.update()
+
+  def zip_manifest(self, path, st):
+    """Return the manifest of the directory 'path' for ZIP archives: a
+    tuple with a (name, size, mtime, crc) tuple for each file in it, and
+    a tuple with the names of its subdirectories.  'st' is the
+    directory's os.stat() result.  The manifest is kept in the metadata
+    cache, if there is one, keyed on the directory's size and mtime, and
+    the CRCs are computed when it is built.  Without a cache they are
+    left to the ZipStream (as None), and the archive can't be resumed."""
+    cache = self.metacache
+    if cache is not None:
+      info = cache.lookup(path, st)
+      if info is not None and info.has_key('files'):
+        return info['files'], info['subdirs']
+
+    files = [ ]
+    subdirs = [ ]
+    for name, mode, is_link in list_dir(path):
+      if not _usable_file(name):
+        continue
+      if is_dir(mode):
+        subdirs.append(name)
+      elif mode is not None and stat.S_ISREG(mode):
+        filename = os.path.join(path, name)
+        try:
+          if cache is None:
+            fst = os.stat(filename)
+            files.append((name, fst.st_size, fst.st_mtime, None))
+          else:
+            files.append((name,) + zipstream.checksum(filename))
+        except EnvironmentError:
+          continue
+    files = tuple(files)
+    subdirs = tuple(subdirs)
+    # a directory changed within its mtime's resolution may change again
+    # without that showing; see filecache.MTIME_SLACK
+    if cache is not None and time.time() - st.st_mtime >= MTIME_SLACK:
+      cache.store(path, st, {'files': files, 'subdirs': subdirs})
+    return files, subdirs
+
   def hms(self, t):
     """Return a string hhhh:mm:ss for a time in seconds."""
     return `t / 3600` + ':' + string.zfill(`(t / 60) % 60`, 2) + ':' + string.zfill(`t % 60`, 2)
 
-  def filename_cache_refresh(self):
-    """Refresh the filenames cache.  Called by the scheduler"""
+  def filename_cache_owner(self):
+    """Return the server which owns the filenames cache now: this one, or
+    the one which took it over when the configuration was reloaded."""
+    svr = self
+    while svr.successor is not None:
+      svr = svr.successor
+    return svr
+
+  def filename_cache_refresh(self, incremental=None):
+    """Refresh the filenames cache.  Called by the scheduler.  A refresh
+    still running when the configuration is reloaded hands its results
+    to the new server."""
+    if incremental is None:
+      incremental = self.incremental_refresh
     start_time = time.time()
-    self.filename_cache = self.get_filenames()
+    cache = self.filename_cache
+    self.filename_cache_lock.acquire()
+    try:
+      listed = cache.refresh(self.filename_cache_owner().dirs, incremental,
+                             self.log_message, self.max_depth,
+                             self.max_entries)
+      owner = self.filename_cache_owner()
+      owner.search_index = SearchIndex(cache)
+      if owner.snapshot_file and (listed or owner.filename_cache_dirty or
+                                  not os.path.exists(owner.snapshot_file)):
+        owner.filename_cache_save()
+    finally:
+      self.filename_cache_lock.release()
     self.log_message( \
       "edna: Filename cache refresh started at " + time.ctime(start_time) \
       + ", took " + `int(round(time.time() - start_time))` \
-      + " seconds, found " + `len(self.filename_cache)` \
-      + " files and directories.")
-     
+      + " seconds, found " + `len(cache)` \
+      + " files and directories, listed " + `listed` + " of " \
+      + `cache.directories()` + " directories.")
+
+  def filename_cache_update(self, rootname, reldir):
+    """Apply a change to one directory to the filenames cache and the
+    search index.  Called by the watcher"""
+    self.filename_cache_lock.acquire()
+    try:
+      added, removed = self.filename_cache.update(rootname, reldir,
+                                                  self.max_depth,
+                                                  self.max_entries)
+      owner = self.filename_cache_owner()
+      index = owner.search_index
+      if index is not None:
+        # index the directories which changed again, as a whole
+        dirs = self.filename_cache.dirs
+        changed = { }
+        for entry in added + removed:
+          changed[entry[:2]] = None
+        changed = changed.keys()
+        changed.sort()
+        for key in changed:
+          if dirs.has_key(key):
+            index.index_dir(key, dirs[key][1])
+          else:
+            index.drop_dir(key)
+      if added or removed:
+        owner.filename_cache_dirty = 1
+    finally:
+      self.filename_cache_lock.release()
+    self.debug_message("filename cache: %s/%s changed, %d added, %d removed"
+                       % (rootname, reldir, len(added), len(removed)))
+    return added, removed
+
+  def filename_cache_adopt(self, previous):
+    """Take over the filenames cache and search index of the server this
+    one replaces.  This doesn't wait for the cache's lock, which a refresh
+    may hold for a long time; a refresh of the previous server which is
+    still running hands its results over to this one when it is done.  If
+    the sources changed, the cache is brought in line with them in the
+    background."""
+    cache = previous.filename_cache
+    self.filename_cache = cache
+    self.filename_cache_lock = previous.filename_cache_lock
+    self.search_index = previous.search_index
+    self.filename_cache_dirty = previous.filename_cache_dirty
+    self.snapshot_mtime = previous.snapshot_mtime
+    # it's ours to save (and to update) now
+    previous.filename_cache_dirty = 0
+    previous.snapshot_file = None
+    previous.successor = self
+
+    if list(cache.roots) != self.dirs:
+      t = threading.Thread(target=self.filename_cache_retarget)
+      t.setDaemon(1)
+      t.start()
+
+  def filename_cache_retarget(self):
+    """Drop the sources which are gone from the filenames cache and the
+    search index, and list the new ones.  Called after a reload."""
+    cache = self.filename_cache
+    self.filename_cache_lock.acquire()
+    try:
+      added = filter(lambda root, old=cache.roots: root not in old, self.dirs)
+      cache.retain(self.dirs)
+      self.search_index = SearchIndex(cache)
+      self.filename_cache_dirty = 1
+    finally:
+      self.filename_cache_lock.release()
+    if added:
+      self.filename_cache_refresh(1)
+
+  def filename_cache_load(self):
+    """Load the filenames cache and search index from the snapshot."""
+    start_time = time.time()
+    # remembered even if the snapshot isn't usable, so that sync_caches()
+    # doesn't try again until it changes
+    self.snapshot_mtime = _mtime(self.snapshot_file)
+    try:
+      # the workers don't change it; they share its pages
+      cache, index = snapshot.load(self.snapshot_file, self.worker)
+    except snapshot.SnapshotError, value:
+      self.log_message("edna: Not using the filename cache snapshot: %s" % value)
+      return
+    if list(cache.roots) != self.dirs:
+      self.log_message("edna: Not using the filename cache snapshot: the sources have changed")
+      return
+    self.filename_cache = cache
+    self.search_index = index
+    self.log_message("edna: Loaded " + `len(index)` \
+      + " files and directories from " + self.snapshot_file + " in " \
+      + `round(time.time() - start_time, 2)` + " seconds.")
+
+  def filename_cache_save(self):
+    """Save the filenames cache and search index to the snapshot.  The
+    caller holds the filename_cache_lock."""
+    try:
+      snapshot.save(self.snapshot_file, self.filename_cache, self.search_index)
+      self.filename_cache_dirty = 0
+      self.snapshot_mtime = _mtime(self.snapshot_file)
+    except (IOError, OSError), value:
+      self.log_message("WARNING: can't save the filename cache snapshot: %s" % value)
+
   def get_filenames(self):
-    """Collect up filenames under the server directories.
-       Server_collect_filenames does all the work."""
-    filenames = [ ]
-    for root, name in self.dirs:
-      os.path.walk(root, Server_collect_filenames, (root, name, filenames))
-    return filenames
+    """Collect up filenames under the server directories, bypassing the
+       cache.  FilenameCache does all the work."""
+    cache = FilenameCache()
+    cache.refresh(self.dirs, 0, self.log_message, self.max_depth,
+                  self.max_entries)
+    return cache.entries()
+
+  def metadata_index(self):
+    """Parse the songs which aren't in the metadata cache yet.  Called by
+    the scheduler"""
+    indexed = ['.mp3']
+    if oggSupport == 'yes':
+      indexed.append('.ogg')
+    indexer = self.indexer
+    indexer.run(map(lambda d: d[0], self.dirs), indexed)
+    self.log_message( \
+      "edna: Metadata indexing started at " + time.ctime(indexer.started) \
+      + ", took " + `int(round(indexer.finished - indexer.started))` \
+      + " seconds, parsed " + `indexer.scanned` + " songs (" \
+      + `indexer.cached` + " already cached, " + `indexer.errors` \
+      + " errors).")
 
   def server_close(self):
     """Shut down the server."""
+    if mixin is ThreadPoolMixIn:
+      self.stop_pool()
+    if self.stream_loop is not None:
+      # it exits once the songs it is sending have been sent
+      self.stream_loop.stop()
     if self.filename_cache_refresh_scheduler:
       print "edna: Shutting down filename cache refresh scheduler"
       self.filename_cache_refresh_scheduler.stop()
-    SocketServer.TCPServer.server_close(self)
+    if self.filename_cache_watcher:
+      self.filename_cache_watcher.stop()
+    if self.snapshot_file and self.filename_cache_dirty:
+      # keep what the watcher applied since the last refresh
+      self.filename_cache_lock.acquire()
+      try:
+        self.filename_cache_save()
+      finally:
+        self.filename_cache_lock.release()
+    if self.metadata_index_scheduler:
+      print "edna: Shutting down metadata indexing scheduler"
+      self.metadata_index_scheduler.stop()
+      self.indexer.stop()
+    if self.metacache is not None:
+      self.metacache.close()
+    if self.socket is not None:
+      SocketServer.TCPServer.server_close(self)
+
+  def reject_request(self, request, client_address):
+    """Called by the ThreadPoolMixIn when too many connections are waiting
+    for a worker thread."""
+    self.log_message("edna: too many connections, turning away %s"
+                     % client_address[0])
+    body = "<html><body><h1>503 Service Unavailable</h1>\n" \
+           "<p>The server is busy.  Please try again later.</p></body></html>\n"
+    try:
+      request.sendall("HTTP/1.0 503 Service Unavailable\r\n"
+                      "Content-Type: text/html\r\n"
+                      "Content-Length: %d\r\n"
+                      "Retry-After: 10\r\n"
+                      "Connection: close\r\n\r\n%s" % (len(body), body))
+    except socket.error:
+      pass
+
+  def stream_start(self):
+    """Claim one of the max_streams slots for streaming a song.  Returns
+    false if they are all taken."""
+    self.streams_lock.acquire()
+    try:
+      if self.max_streams > 0 and self.streams >= self.max_streams:
+        return 0
+      self.streams = self.streams + 1
+      return 1
+    finally:
+      self.streams_lock.release()
+
+  def stream_end(self):
+    self.streams_lock.acquire()
+    self.streams = self.streams - 1
+    self.streams_lock.release()
+
+  def process_request(self, request, client_address):
+    self.connections_lock.acquire()
+    self.connections = self.connections + 1
+    self.connections_lock.release()
+    mixin.process_request(self, request, client_address)
+    if mixin is ThreadPoolMixIn and self.pool_busy():
+      # connections are waiting for a worker thread, while others keep
+      # theirs only to wait for a next request; let those go
+      self.close_idle_connections()
+
+  def shutdown_request(self, request):
+    self.connections_lock.acquire()
+    self.connections = self.connections - 1
+    self.connections_lock.release()
+    # connections handed to the stream loop are closed (and counted) by
+    # the loop
+    if self.stream_loop is not None and self.stream_loop.owns(request):
+      return
+    SocketServer.TCPServer.shutdown_request(self, request)
+
+  def connection_idle(self, conn, idle):
+    """Called by the request handler when it starts and stops waiting for
+    the next request on a kept-alive connection.  Once the server is
+    draining, idle connections are closed rather than waited for."""
+    self.connections_lock.acquire()
+    try:
+      if not idle:
+        if self.idle_connections.has_key(id(conn)):
+          del self.idle_connections[id(conn)]
+      elif self.draining:
+        _shutdown(conn)
+      else:
+        self.idle_connections[id(conn)] = conn
+    finally:
+      self.connections_lock.release()
+
+  def in_flight(self):
+    """Return the number of connections being served."""
+    count = self.connections
+    if self.stream_loop is not None:
+      count = count + len(self.stream_loop)
+    return count
+
+  def stop_serving(self):
+    """Stop accepting connections, close the kept-alive connections which
+    are waiting for a request, and close the others once their current
+    request is done."""
+    self.draining = 1
+    self.close_idle_connections()
+    self.server_close()
+
+  def close_idle_connections(self):
+    """Close the kept-alive connections which are waiting for their next
+    request, so that their threads are free for other connections."""
+    self.connections_lock.acquire()
+    try:
+      for conn in self.idle_connections.values():
+        _shutdown(conn)
+      self.idle_connections = { }
+    finally:
+      self.connections_lock.release()
+
+  def drain(self, timeout=None):
+    """Wait for the connections being served to finish, for at most
+    'timeout' seconds if it isn't None.  Returns the number of connections
+    that are still open."""
+    if timeout is not None:
+      deadline = time.time() + timeout
+    while self.in_flight():
+      if timeout is not None and time.time() >= deadline:
+        break
+      time.sleep(0.1)
+    return self.in_flight()
+
+  def serve(self, wakeup):
+    """Accept connections until a signal handler asks for something else
+    by clearing 'running' or setting 'config_needed'.  'wakeup' is the read
+    end of the pipe that becomes readable when a signal arrives, or None
+    if there isn't one (then signals are noticed within a second)."""
+    fds = [ self.socket ]
+    timeout = 1
+    if wakeup is not None:
+      fds.append(wakeup)
+      timeout = None
+    while running and not config_needed:
+      try:
+        ready = select.select(fds, [ ], [ ], timeout)[0]
+      except (select.error, socket.error), e:
+        if e[0] == errno.EINTR:
+          continue
+        raise
+      if wakeup in ready:
+        _drain_pipe(wakeup)
+      if self.socket in ready:
+        self._handle_request_noblock()
 
   def server_bind(self):
     # set SO_REUSEADDR (if available on this platform)
@@ -336,33 +894,99 @@ class Server(mixin, BaseHTTPServer.HTTPServer):
       return
     self.log_message ('DEBUG: ' + msg)
 
-def Server_collect_filenames(context, dirname, filenames):
-  """Called by os.walk(), collects up file and directory names into
-  a list of tuples containing the root directory name, the relative
-  path from the root to the file, and the filename.  Path separators
-  are translated to "/".  Marks directories by appending "/" to the name.
-  It's important that this function collects *everything* that the search
-  needs to qualify search results.  Otherwise searches will have to hit the
-  filesystem, which is what we're trying to avoid.  For example, if we 
-  wanted to allow searches by date, this function should collect the file
-  dates."""
-  rootdir, rootname, resultlist = context
-  reldir = string.replace(dirname[len(rootdir)+1:], os.sep, '/')
-  for filename in filenames:
-    if os.path.isdir(os.path.join(dirname, filename)):
-      resultlist.append((rootname, reldir, filename + '/'))
-    else:
-      resultlist.append((rootname, reldir, filename))
-
 class EdnaRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
+  # every response has a Content-Length or is chunked, so connections can
+  # be kept open for further requests (see handle)
+  protocol_version = 'HTTP/1.1'
+
+  def handle(self):
+    """Handle requests until the client closes the connection, leaves it
+    idle for keepalive_timeout seconds or has made keepalive_max requests."""
+    self.requests = 0
+    self.close_connection = 0
+    try:
+      while not self.close_connection:
+        self.idle = 1
+        self.connection_header = 0
+        self.connection.settimeout(self.server.keepalive_timeout or None)
+        if self.requests:
+          self.server.connection_idle(self.connection, 1)
+        try:
+          self.handle_one_request()
+        except socket.error:
+          # the client went away, most likely while we waited for a request
+          self.close_connection = 1
+    finally:
+      self.server.connection_idle(self.connection, 0)
+
+  def parse_request(self):
+    self.idle = 0
+    self.server.connection_idle(self.connection, 0)
+    self.connection_header = 0
+    if not BaseHTTPServer.BaseHTTPRequestHandler.parse_request(self):
+      return 0
+    # the request is in; sending the response may take as long as it takes
+    self.connection.settimeout(None)
+    self.requests = self.requests + 1
+    if self.requests >= self.server.keepalive_max:
+      self.close_connection = 1
+    elif mixin is ThreadPoolMixIn and self.server.pool_busy():
+      # don't hold on to the worker while other connections wait for one
+      self.close_connection = 1
+    elif self.server.draining:
+      self.close_connection = 1
+    return 1
+
+  def send_header(self, keyword, value):
+    if string.lower(keyword) == 'connection':
+      self.connection_header = 1
+    BaseHTTPServer.BaseHTTPRequestHandler.send_header(self, keyword, value)
+
+  def end_headers(self):
+    if not self.connection_header:
+      if self.close_connection:
+        self.send_header('Connection', 'close')
+      elif self.request_version != 'HTTP/1.1':
+        # a HTTP/1.0 client which asked to keep the connection open
+        self.send_header('Connection', 'keep-alive')
+    BaseHTTPServer.BaseHTTPRequestHandler.end_headers(self)
+
+  def send_error(self, code, message=None, headers=()):
+    """Like BaseHTTPRequestHandler.send_error, but with a Content-Length
+    so that the connection can be kept open after a failed GET, and
+    optionally more headers, as (name, value) pairs."""
+    try:
+      short, long = self.responses[code]
+    except KeyError:
+      short, long = '???', '???'
+    if message is None:
+      message = short
+    self.log_error("code %d, message %s", code, message)
+    body = self.error_message_format % {'code': code,
+                                        'message': cgi.escape(message),
+                                        'explain': long}
+    if self.command != 'GET':
+      # the request couldn't be parsed (or has a body we didn't read)
+      self.close_connection = 1
+    self.send_response(code, message)
+    self.send_header("Content-Type", self.error_content_type)
+    self.send_header("Content-Length", len(body))
+    for name, value in headers:
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(body)
+
   def do_GET(self):
+    if self.server.worker:
+      self.server.sync_caches()
     try:
       self._perform_GET()
     except ClientAbortedException:
       self.server.debug_message('Exception caught in "do_GET" --- ClientAbortException')
+      self.close_connection = 1
     except IOError:
-      pass
+      self.close_connection = 1
 
   def check_authorization(self):
     auth_table = self.server.auth_table
@@ -430,10 +1054,12 @@ class EdnaRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       return
 
     if path == ["robots.txt"] and self.server.config.getint('server', 'robots') != 0:
+      robots = "User-agent: *\nDisallow /\n"
       self.send_response(200)
       self.send_header("Content-Type", "text/plain")
+      self.send_header("Content-Length", len(robots))
       self.end_headers()
-      self.wfile.write("User-agent: *\nDisallow /\n")
+      self.wfile.write(robots)
       return
 
     self.output_style = 'html'
@@ -482,9 +1108,9 @@ class EdnaRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       for p in path:
         if p == 'all.m3u' or p == 'allrecursive.m3u' or \
            p == 'shuffle.m3u' or p == 'shufflerecursive.m3u' or \
-           p == 'all.zip':
+           p == 'all.zip' or p == 'allrecursive.zip':
           # serve up a pseudo-file
-          self.serve_file(p, curdir, url)
+          self.serve_file(p, curdir, url, self.headers.getheader('range'))
           return
 
         pathname = os.path.join(curdir, p)
@@ -525,6 +1151,26 @@ class EdnaRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       playlists = []
       plainfiles = []
 
+      # The page changes with the directory, and with the mtimes of its
+      # subdirectories (they are shown as new) and of its songs (their
+      # tags are shown); a cached page is used as long as none of them
+      # changed.  It is made with the template, and with what is shown
+      # as new or hidden, at the time.
+      cache = self.server.page_cache
+      if cache is not None:
+        page_key = (self.path, self.output_style, self.build_url(''),
+                    self.page_template()[0], DAYS_NEW, tuple(HIDE_EXACT),
+                    tuple(HIDE_MATCH), self.server.fileinfo)
+        page = cache.get(page_key)
+        if page is not None:
+          self.send_cached_page(page)
+          return
+        try:
+          deps = [ (curdir, os.stat(curdir)[stat.ST_MTIME]) ]
+        except OSError:
+          cache = None
+      expires = None
+
       if path:
         thisdir = path[-1]
       else:
@@ -535,11 +1181,17 @@ class EdnaRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       for name in sort_dir(curdir):
         href = urllib.quote(name)
         try:
-          is_new = check_new(os.stat(os.path.join(curdir, name))[stat.ST_MTIME])
+          mtime = os.stat(os.path.join(curdir, name))[stat.ST_MTIME]
         except: 
           # For example, in the case of disk I/O errors
           print "Failed to stat %s"%(name)
           continue
+        is_new = check_new(mtime)
+        if is_new:
+          # no longer new after that
+          t = mtime + DAYS_NEW * 86400
+          if expires is None or t < expires:
+            expires = t
         nameLower = name.lower()
         if nameLower in HIDE_EXACT: continue
         skip = False
@@ -582,18 +1234,27 @@ class EdnaRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
           d = _datablob(href=href, is_new=is_new, text=base)
           if self.server.fileinfo:
-            info = FileInfo(fullpath)
+            info = FileInfo(fullpath, self.server.metacache)
           else:
             info = _datablob()
           d.info = empty_delegator(info)
+          if cache is not None and self.server.fileinfo:
+            deps.append((fullpath, mtime))
 
           songs.append(d)
         else:
           newdir = os.path.join(curdir, name)
           if os.path.isdir(fullpath):
             subdirs.append(_datablob(href=href + '/', is_new=is_new, text=name))
+            if cache is not None:
+              deps.append((fullpath, mtime))
 
-      self.display_page(title, subdirs, pictures, plainfiles, songs, playlists)
+      if cache is not None:
+        self.display_page(title, subdirs, pictures, plainfiles, songs,
+                          playlists, cache=(page_key, deps, expires))
+      else:
+        self.display_page(title, subdirs, pictures, plainfiles, songs,
+                          playlists)
 
   def filename_qualifies(self, query, filename):
     """This function checks whether a 'filename' string qualifies as results
@@ -601,10 +1262,13 @@ class EdnaRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     to make the search work differently.  This implementation qualifies a
     filename if it contains all of the search word substrings; a search for
     e.g., "yo yo" will match "Yo Yo Ma" but also "Your Cheating Heart".
+    Searches of the filename cache go through the server's SearchIndex,
+    which implements the same rule.
     """
+    filename = string.lower(filename)
     search_words = string.split(query, ' ')
     for word in search_words:
-      if string.find(string.lower(filename), string.lower(word)) == -1:
+      if string.find(filename, string.lower(word)) == -1:
         return 0
     return 1
 
@@ -626,37 +1290,37 @@ class EdnaRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     queryvars = cgi.parse_qs(querystring)
     if queryvars.has_key('query'):
       query = queryvars['query'][0]
-      filenames = self.server.filename_cache
-      if filenames == None:
-        filenames = self.server.get_filenames()
-      for root, dir, name in filenames:
-        if self.filename_qualifies(query, name):
-	  if len(self.server.dirs) > 1:
-	    link_path = root + '/' + dir + '/' + name
-	  else:
-	    link_path = dir + '/' + name
-          display_path = cgi.escape(string.replace(os.path.splitext(link_path)[0], "/", " / "))
-          if name[-1:] == '/':
-            subdirs.append(_datablob(href=urllib.quote(link_path), is_new='', text=display_path))
-          else:
-            if extensions.has_key(os.path.splitext(name)[1]):
-              d = _datablob(href=urllib.quote(link_path), is_new='', text=display_path)
-              if self.server.fileinfo:
-                for sd in self.server.dirs:
-                  if sd[1] == root:
-                    fullpath = os.path.join(sd[0], string.replace(dir, "/", os.sep), name)
-                info = FileInfo(fullpath)
-              else:
-                info = _datablob()
-              d.info = empty_delegator(info)
-              songs.append(d)
+      index = self.server.search_index
+      if index is not None:
+        results = index.search(query)
+      else:
+        results = [ ]
+        for entry in self.server.get_filenames():
+          if self.filename_qualifies(query, entry[2]):
+            results.append(entry)
+      for root, dir, name in results:
+        if len(self.server.dirs) > 1:
+          link_path = root + '/' + dir + '/' + name
+        else:
+          link_path = dir + '/' + name
+        display_path = cgi.escape(string.replace(os.path.splitext(link_path)[0], "/", " / "))
+        if name[-1:] == '/':
+          subdirs.append(_datablob(href=urllib.quote(link_path), is_new='', text=display_path))
+        else:
+          if extensions.has_key(os.path.splitext(name)[1]):
+            d = _datablob(href=urllib.quote(link_path), is_new='', text=display_path)
+            if self.server.fileinfo:
+              for sd in self.server.dirs:
+                if sd[1] == root:
+                  fullpath = os.path.join(sd[0], string.replace(dir, "/", os.sep), name)
+              info = FileInfo(fullpath, self.server.metacache)
+            else:
+              info = _datablob()
+            d.info = empty_delegator(info)
+            songs.append(d)
     self.display_page(TITLE, subdirs, songs=songs, skiprec=1)
     
   def display_stats(self):
-    self.send_response(200)
-    self.send_header("Content-Type", 'text/html')
-    self.end_headers()
-
     data = { 'users' : [ ],
              'ips' : [ ],
              }
@@ -678,22 +1342,47 @@ class EdnaRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       d.count, tm = ip_log[ip]
       d.time = time.strftime("%B %d %I:%M:%S %p", time.localtime(tm))
       data['ips'].append(d)
-    self.server.stats_template.generate(self.wfile, data)
 
-  def display_page(self, title, subdirs, pictures=[], plainfiles=[], songs=[], playlists=[],
-                   skiprec=0):
+    data['metacache'] = ''
+    data['pagecache'] = ''
+    data['indexer'] = ''
+    cache = self.server.metacache
+    if cache is not None:
+      data['metacache'] = _datablob(entries=len(cache), hits=cache.hits,
+                                    misses=cache.misses)
+    cache = self.server.page_cache
+    if cache is not None:
+      data['pagecache'] = _datablob(entries=len(cache),
+                                    size=(cache.size + 1023) / 1024,
+                                    hits=cache.hits, misses=cache.misses)
+    indexer = self.server.indexer
+    if indexer and indexer.started:
+      d = _datablob()
+      if indexer.running:
+        d.state = 'running'
+      else:
+        d.state = 'finished ' + time.strftime("%B %d %I:%M:%S %p",
+                                              time.localtime(indexer.finished))
+      d.started = time.strftime("%B %d %I:%M:%S %p",
+                                time.localtime(indexer.started))
+      d.scanned = indexer.scanned
+      d.cached = indexer.cached
+      d.errors = indexer.errors
+      d.remaining = indexer.remaining()
+      if indexer.walking:
+        d.remaining = `d.remaining` + '+'
+      d.rate = '%.1f' % indexer.files_per_second()
+      data['indexer'] = d
+
+    self.send_page(self.server.stats_template, data, 'text/html')
 
-    ### implement a URL-selectable style here with a cache of templates
-    if self.output_style == 'html':
-      template = self.server.default_template
-      content_type = 'text/html'
-    else: # == 'xml'
-      template = self.server.xml_template
-      content_type = 'text/xml'
+  def display_page(self, title, subdirs, pictures=[], plainfiles=[], songs=[], playlists=[],
+                   skiprec=0, cache=None):
+    """Send a directory page.  If 'cache' is given, it holds the key, the
+    dependencies and the expiry time with which the page is stored in the
+    page cache."""
 
-    self.send_response(200)
-    self.send_header("Content-Type", content_type)
-    self.end_headers()
+    template, content_type = self.page_template()
 
     data = { 'title' : title,
              'links' : self.tree_position(),
@@ -709,7 +1398,107 @@ class EdnaRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     else:
       data['display-recursive'] = ''
 
-    template.generate(self.wfile, data)
+    if cache is None:
+      self.send_page(template, data, content_type)
+    else:
+      # sent as it is generated, like any page, and kept as well
+      key, deps, expires = cache
+      etag, last_modified = validators(key, deps)
+      pieces = [ ]
+      self.send_page(template, data, content_type,
+                     [("ETag", etag),
+                      ("Last-Modified", self.date_time_string(last_modified))],
+                     pieces)
+      self.server.page_cache.add(key, string.join(pieces, ''), content_type,
+                                 deps, expires, etag, last_modified)
+
+  def page_template(self):
+    "Return the template and content type of the directory pages."
+    ### implement a URL-selectable style here with a cache of templates
+    if self.output_style == 'html':
+      return self.server.default_template, 'text/html'
+    else: # == 'xml'
+      return self.server.xml_template, 'text/xml'
+
+  def send_cached_page(self, page):
+    """Send a page from the page cache, or just 304 if the client's copy
+    is current."""
+    if self.not_modified(page.etag, page.last_modified):
+      self.send_response(304)
+      self.send_header("ETag", page.etag)
+      self.end_headers()
+      return
+    self.send_response(200)
+    self.send_header("Content-Type", page.content_type)
+    self.send_header("Content-Length", len(page.body))
+    self.send_header("ETag", page.etag)
+    self.send_header("Last-Modified",
+                     self.date_time_string(page.last_modified))
+    self.end_headers()
+    self.wfile.write(page.body)
+
+  def not_modified(self, etag, mtime):
+    """Return true if the If-None-Match or If-Modified-Since header of the
+    request shows that the client has the current version of an entity
+    with the given entity tag and modification time.  Either may be None
+    if unknown."""
+    if_none_match = self.headers.getheader('if-none-match')
+    if if_none_match:
+      # takes precedence over If-Modified-Since
+      if etag is None:
+        return 0
+      for tag in string.split(if_none_match, ','):
+        tag = string.strip(tag)
+        if tag[:2] == 'W/':
+          tag = tag[2:]
+        if tag == etag or tag == '*':
+          return 1
+      return 0
+    since = self.headers.getheader('if-modified-since')
+    if since and mtime:
+      date = rfc822.parsedate_tz(since)
+      if date is not None:
+        try:
+          return rfc822.mktime_tz(date) >= int(mtime)
+        except (OverflowError, ValueError):
+          pass
+    return 0
+
+  def send_page(self, template, data, content_type, headers=(), keep=None):
+    """Generate a page from 'template' and send it, with the extra headers
+    in 'headers', (name, value) pairs.  HTTP/1.1 clients get it as it is
+    generated, in chunks; older ones only understand a Content-Length, so
+    the page is generated in memory first.  If 'keep' is a list, the page
+    is appended to it too, in pieces.  Returns the size of the page."""
+    start_time = time.time()
+    if self.request_version == 'HTTP/1.1':
+      self.send_response(200)
+      self.send_header("Content-Type", content_type)
+      self.send_header("Transfer-Encoding", "chunked")
+      for name, value in headers:
+        self.send_header(name, value)
+      self.end_headers()
+      out = _ChunkedWriter(self.wfile, keep=keep)
+      template.generate(out, data)
+      out.close()
+      size = out.written
+    else:
+      out = StringIO.StringIO()
+      template.generate(out, data)
+      page = out.getvalue()
+      self.send_response(200)
+      self.send_header("Content-Type", content_type)
+      self.send_header("Content-Length", len(page))
+      for name, value in headers:
+        self.send_header(name, value)
+      self.end_headers()
+      self.wfile.write(page)
+      size = len(page)
+      if keep is not None:
+        keep.append(page)
+    self.server.debug_message('"%s": %d bytes rendered in %.3f seconds'
+                              % (self.path, size, time.time() - start_time))
+    return size
 
   def tree_position(self):
     mypath = self.translate_path()
@@ -731,40 +1520,53 @@ class EdnaRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     return '<p>' + string.join(links, '\n') + '</p>'
 
-  def make_list(self, fullpath, url, recursive, shuffle, songs=None):
-    # This routine takes a string for 'fullpath' and 'url', a list for
-    # 'songs' and a boolean for 'recursive' and 'shuffle'. If recursive is
-    # false make_list will return a list of every file ending in '.mp3' in
-    # fullpath. If recursive is true make_list will return a list of every
-    # file ending in '.mp3' in fullpath and in every directory beneath
-    # fullpath.
+  def make_list(self, fullpath, url, recursive, shuffle):
+    # This routine takes a string for 'fullpath' and 'url', and a boolean
+    # for 'recursive' and 'shuffle'. If recursive is false make_list will
+    # return a list of the URLs of every song in fullpath. If recursive is
+    # true make_list will return a list of the URLs of every song in
+    # fullpath and in every directory beneath fullpath, in the order of
+    # the directory listings.  Without a 'url' the list is of every file
+    # instead (but those hidden from the pages), with its path relative
+    # to fullpath.
     #
-    # WARNING: There is no checking for the recursive directory structures
-    # which are possible in most Unixes using ln -s etc...  If you have
-    # such a directory structure, make_list will continue to traverse it 
-    # until it hits the inherent limit in Python for the number of functions.
-    # This number is quite large. I found this out the hard way :). Learn
-    # from my experience...
-
-    if songs is None:
-      songs = []
+    # Symbolic links to directories are followed.  The Walker goes into
+    # each directory only once, so a link back up the tree can't make
+    # this go round in circles.
 
-    for name in sort_dir(fullpath):
-      if url:
-        base, ext = os.path.splitext(name)
-        if extensions.has_key(string.lower(ext)):
-          # add the song's URL to the list we're building
-          songs.append(self.build_url(url, name) + '\n')
-      else:
-        if os.path.isfile(fullpath + '/' + name):
-          songs.append(name)
+    if url:
+      prefix = self.build_url(url)
+    listdir = lambda path, reldir, st, recursive=recursive, files=not url: \
+                _listing(path, recursive, files)
 
-      # recurse down into subdirectories looking for more MP3s.
-      if recursive and os.path.isdir(fullpath + '/' + name):
-        songs = self.make_list(fullpath + '/' + name,
-                               url + '/' + urllib.quote(name),
-                               recursive, 0,	# don't shuffle subdir results
-                               songs)
+    # each directory's entries go in a list of their own, which holds the
+    # lists of its subdirectories where they come in the listing
+    songs = [ ]
+    lists = { '': songs }
+    walk = Walker(self.server.max_depth, self.server.max_entries,
+                  self.server.debug_message).walk(fullpath, listdir)
+    for path, reldir, st, listing in walk:
+      entries = lists[reldir]
+      del lists[reldir]
+      if url:
+        if reldir:
+          dirprefix = prefix + urllib.quote(reldir) + '/'
+        else:
+          dirprefix = prefix
+      for name, mode in listing:
+        if is_dir(mode):
+          if recursive:
+            sub = [ ]
+            entries.append(sub)
+            lists[join(reldir, name)] = sub
+        elif url:
+          base, ext = os.path.splitext(name)
+          if extensions.has_key(string.lower(ext)):
+            # add the song's URL to the list we're building
+            entries.append(dirprefix + urllib.quote(name) + '\n')
+        elif mode is not None and stat.S_ISREG(mode):
+          entries.append(join(reldir, name))
+    songs = _flatten(songs)
 
     # The user asked us to mix up the results.
     if shuffle:
@@ -775,6 +1577,92 @@ class EdnaRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     return songs
 
+  def zip_entries(self, fullpath, recursive):
+    """Return the entries of the ZIP archive of the directory 'fullpath'
+    for a ZipStream: its files, and with 'recursive' those below it too,
+    but not those hidden from the pages.  They are taken from the
+    manifests of the directories (see Server.zip_manifest()), so only the
+    directories are stat()ed.  Also returns the latest mtime of the
+    directories."""
+    server = self.server
+    dirname = os.path.basename(fullpath)
+    def listdir(path, reldir, st, server=server, recursive=recursive):
+      files, subdirs = server.zip_manifest(path, st)
+      count = len(files) + len(subdirs)
+      if recursive:
+        subdirs = filter(lambda name: not _hidden(name), subdirs)
+      else:
+        subdirs = ()
+      return files, subdirs, count
+
+    entries = [ ]
+    mtime = 0
+    walk = Walker(server.max_depth, server.max_entries,
+                  server.debug_message).walk(fullpath, listdir)
+    for path, reldir, st, files in walk:
+      mtime = max(mtime, st.st_mtime)
+      for name, size, file_mtime, crc in files:
+        if not _hidden(name):
+          entries.append((os.path.join(path, name),
+                          dirname + '/' + join(reldir, name),
+                          size, file_mtime, crc))
+    return entries, mtime
+
+  def send_cached_playlist(self, fullpath, url, shuffle, base):
+    """Send the recursive playlist of 'fullpath', made from the filename
+    cache rather than from the disk.  Unless it is shuffled, HTTP/1.1
+    clients get it in chunks, as it is put together.  Returns false,
+    without sending anything, if the directory isn't in the cache."""
+    cache = self.server.filename_cache
+    if cache is None:
+      return 0
+    key = cache.locate(fullpath)
+    dirs = cache.dirs
+    if key is None or not dirs.has_key(key):
+      return 0
+
+    start_time = time.time()
+    def outside(path, fullpath=fullpath, url=url, self=self):
+      # not in the cache; the directory has to be listed after all
+      if path:
+        fullpath = os.path.join(fullpath, path)
+        url = url + '/' + urllib.quote(path)
+      return string.join(self.make_list(fullpath, url, 1, 0), '')
+
+    playlists = self.server.playlist_cache
+    prefix = self.build_url(url)
+    if shuffle or self.request_version != 'HTTP/1.1':
+      pieces = [ ]
+      playlists.write(pieces.append, dirs, key, prefix,
+                      lambda path, f=outside, l=pieces: l.append(f(path)))
+      body = string.join(pieces, '')
+      if shuffle:
+        songs = string.split(body, '\n')[:-1]
+        random.shuffle(songs)
+        if songs:
+          body = string.join(songs, '\n') + '\n'
+      self.send_response(200)
+      self.send_header("Content-Type", "audio/x-mpegurl")
+      self.send_header("Content-Length", len(body))
+      self.send_header("icy-name", base)
+      self.end_headers()
+      self.wfile.write(body)
+      size = len(body)
+    else:
+      self.send_response(200)
+      self.send_header("Content-Type", "audio/x-mpegurl")
+      self.send_header("Transfer-Encoding", "chunked")
+      self.send_header("icy-name", base)
+      self.end_headers()
+      out = _ChunkedWriter(self.wfile)
+      playlists.write(out.write, dirs, key, prefix,
+                      lambda path, f=outside, out=out: out.write(f(path)))
+      out.close()
+      size = out.written
+    self.server.debug_message('"%s": %d bytes of playlist in %.3f seconds'
+                              % (self.path, size, time.time() - start_time))
+    return 1
+
   def open_playlist(self, fullpath, url):
     dirpath = os.path.dirname(fullpath)
     f = open(fullpath)
@@ -802,9 +1690,49 @@ class EdnaRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     return f
 
   def serve_file(self, name, fullpath, url, range=None):
+    if (name == 'all.zip' or name == 'allrecursive.zip') \
+       and self.server.zipmax > 0:
+      # ZIP downloads take their turn
+      ip = self.client_address[0]
+      try:
+        self.server.zip_scheduler.start(ip, self.path)
+      except Busy, e:
+        if e.position is None:
+          message = 'The ZIP download can\'t start: %s.' % e.reason
+          self.send_error(503, message, [('Retry-After', ZIP_RETRY)])
+        else:
+          # Retry-After for download managers; browsers reload the page
+          message = 'The ZIP download can\'t start yet: %s (it is number ' \
+                    '%d in line).  It will be tried again every %d ' \
+                    'seconds.' % (e.reason, e.position, ZIP_RETRY)
+          self.send_error(503, message, [('Retry-After', ZIP_RETRY),
+                                         ('Refresh', ZIP_RETRY)])
+        return
+      try:
+        self._serve_file(name, fullpath, url, range)
+      finally:
+        self.server.zip_scheduler.finish(ip)
+      return
+
+    # songs take a worker thread for as long as they play; limit how many
+    # can do that, so that there are always threads left for the pages
+    ext = string.lower(os.path.splitext(name)[1])
+    if not extensions.has_key(ext):
+      self._serve_file(name, fullpath, url, range)
+      return
+    if not self.server.stream_start():
+      self.send_error(503, 'Too many streams are playing.  Please try again later.')
+      return
+    try:
+      self._serve_file(name, fullpath, url, range)
+    finally:
+      self.server.stream_end()
+
+  def _serve_file(self, name, fullpath, url, range=None):
     base, ext = os.path.splitext(name)
     ext = string.lower(ext)
     mtime = None
+    stream = None
     if any_extensions.has_key(ext):
       if not picture_extensions.has_key(ext):
         # log the request of this file
@@ -827,6 +1755,9 @@ class EdnaRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
          name == 'shuffle.m3u' or name == 'shufflerecursive.m3u':
         recursive = name == 'allrecursive.m3u' or name == 'shufflerecursive.m3u'
         shuffle = name == 'shuffle.m3u' or name == 'shufflerecursive.m3u'
+        if recursive and self.send_cached_playlist(fullpath, url, shuffle,
+                                                   base):
+          return
 
         # generate the list of URLs to the songs
         songs = self.make_list(fullpath, url, recursive, shuffle)
@@ -842,66 +1773,196 @@ class EdnaRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
           f = self.open_playlist(fullpath, url)
           clen = len(f.getvalue())
           mtime = os.stat(fullpath)[stat.ST_MTIME]
-    elif name == 'all.zip':
+    elif name == 'all.zip' or name == 'allrecursive.zip':
       if not self.server.zipmax > 0:
         self.send_error(403, 'The ZIP service has been disabled by the server administrator.')
         return
 
+      # the archive is put together while it is sent
       type = 'application/zip'
-      f = StringIO.StringIO()
-      z = zipfile.ZipFile(f, 'w', zipfile.ZIP_STORED)
-      songs = self.make_list(fullpath, None, None, None)
-      for s in songs:
-        z.write(fullpath + '/' + s, os.path.basename(fullpath) + '/' + s)
-        if self.server.zipsize + len(f.getvalue()) > self.server.zipmax:
-          break
-
-      z.close()
-      f.seek(0)
-      clen = len(f.getvalue())
-      self.server.debug_message("ZUP thresholds: %d + %d vs %d" %
-                                (self.server.zipsize, clen, self.server.zipmax))
-
-      if self.server.zipsize + clen > self.server.zipmax:
-        self.send_error(503, 'The <b>ZIP</b> service is currently under heavy load.  Please try again later.')
+      entries, dirs_mtime = self.zip_entries(fullpath,
+                                             name == 'allrecursive.zip')
+      try:
+        stream = zipstream.ZipStream(entries)
+      except zipstream.ZipError, e:
+        self.send_error(403, 'This directory can\'t be downloaded as a ZIP archive: %s.' % e)
         return
-
-      self.server.zipsize += clen
+      clen = stream.size
+      if clen > self.server.zipmax:
+        self.send_error(403, 'This directory is too big to be downloaded as a ZIP archive.')
+        return
+      if stream.seekable:
+        # with all the CRCs known, the archive comes out the same every
+        # time until a file in it changes, so it can be sent in ranges
+        # (and downloads resumed).  Adding, removing or renaming a file
+        # changes the mtime of its directory.
+        mtime = max(stream.mtime, dirs_mtime)
+      f = ThrottledFile(stream, self.server.zip_scheduler)
     else:
       self.send_error(404)
       return
 
-    self.send_response(200)
-    self.send_header("Content-Type", type)
-    self.send_header("Content-Length", clen)
+    # validators, cache control and byte ranges are only for content that
+    # doesn't change between requests, i.e. which has a modification time.
+    # The resources only change with edna itself, so clients may keep
+    # them for a while; anything else they have to check with us first.
+    ranges = None
+    if mtime:
+      last_modified = self.date_time_string(mtime)
+      etag = '"%x-%x"' % (clen, int(mtime))
+      if url == '/resources':
+        cache_control = 'max-age=%d' % self.server.resource_max_age
+      else:
+        cache_control = 'no-cache'
+      if self.not_modified(etag, mtime):
+        f.close()
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", cache_control)
+        self.end_headers()
+        return
+      if_range = self.headers.getheader('if-range')
+      if if_range:
+        if_range = string.strip(if_range)
+      # the entity has changed if If-Range doesn't match; it is sent in full
+      if range and (not if_range or if_range == etag
+                    or if_range == last_modified):
+        ranges = parse_ranges(range, clen)
+
+    if ranges == [ ]:
+      self.send_response(416)
+      self.send_header("Content-Range", "bytes */%d" % clen)
+      self.send_header("Content-Length", 0)
+      self.end_headers()
+      return
+
+    if ranges and len(ranges) > 1:
+      # each range goes in its own part of a multipart/byteranges body
+      boundary = '%016x' % random.getrandbits(64)
+      parts = [ ]
+      length = 0
+      for first, last in ranges:
+        head = '\r\n--%s\r\nContent-Type: %s\r\n' \
+               'Content-Range: bytes %d-%d/%d\r\n\r\n' \
+               % (boundary, type, first, last, clen)
+        parts.append((head, first, last))
+        length = length + len(head) + last - first + 1
+      tail = '\r\n--%s--\r\n' % boundary
+      length = length + len(tail)
+      self.send_response(206)
+      self.send_header("Content-Type",
+                       "multipart/byteranges; boundary=" + boundary)
+      self.send_header("Content-Length", length)
+    elif ranges:
+      first, last = ranges[0]
+      self.send_response(206)
+      self.send_header("Content-Type", type)
+      self.send_header("Content-Range", "bytes %d-%d/%d" % (first, last, clen))
+      self.send_header("Content-Length", last - first + 1)
+    else:
+      self.send_response(200)
+      self.send_header("Content-Type", type)
+      self.send_header("Content-Length", clen)
     if mtime:
-      self.send_header('Last-Modified', time.strftime("%a, %d %b %Y %T GMT"))
+      self.send_header("Accept-Ranges", "bytes")
+      self.send_header("Last-Modified", last_modified)
+      self.send_header("ETag", etag)
+      self.send_header("Cache-Control", cache_control)
     # Thanks to Stefan Alfredsson <stefan@alfredsson.org>
     # for the suggestion, Now the filenames get displayed right.
     self.send_header("icy-name", base)
+
+    # songs are handed to the stream loop, if there is one, instead of
+    # keeping this thread busy while they play
+    loop = self.server.stream_loop
+    if loop is not None and extensions.has_key(ext) and isinstance(f, file) \
+       and not (ranges and len(ranges) > 1) \
+       and self.connection.__class__ is socket.socket:
+      # the loop closes the connection when it is done
+      self.close_connection = 1
+      self.end_headers()
+      self.wfile.flush()
+      if ranges:
+        first, last = ranges[0]
+        loop.add(self.connection, f, first, last - first + 1)
+      else:
+        loop.add(self.connection, f, 0, clen)
+      return
     self.end_headers()
 
-    #Seek if the client requests it (a HTTP/1.1 request)
-    if range:
-      type, seek = string.split(range,'=')
-      startSeek, endSeek = string.split(seek,'-')
-      f.seek(int(startSeek))
+    try:
+      if ranges and len(ranges) > 1:
+        for head, first, last in parts:
+          self.wfile.write(head)
+          self.send_body(f, first, last - first + 1)
+        self.wfile.write(tail)
+      elif ranges:
+        first, last = ranges[0]
+        self.send_body(f, first, last - first + 1)
+      else:
+        self.send_body(f, 0, clen)
+    except ClientAbortedException:
+      self.log_message('client closed connection for "%s"', self.path)
+      self.close_connection = 1
+    except socket.error:
+      # it was probably closed on the other end
+      self.close_connection = 1
+    except zipstream.ZipError, e:
+      # the archive can't be completed; the client sees it cut short
+      self.log_message('"%s": %s', self.path, e)
+      self.close_connection = 1
+
+    if stream is not None:
+      f.close()
+      if stream.changed and self.server.metacache is not None:
+        # the manifest is out of date without its directory showing it
+        self.server.metacache.forget(os.path.dirname(stream.changed))
+
+  def send_body(self, f, offset, count):
+    """Send 'count' bytes of 'f', starting at 'offset'.  Files on disk are
+    handed to sendfile() when the connection is a plain socket, so that
+    the data doesn't pass through Python; anything else is copied."""
+    if self.server.use_sendfile and isinstance(f, file) \
+       and self.connection.__class__ is socket.socket:
+      # the headers have to go out before the body
+      self.wfile.flush()
+      sock = self.connection.fileno()
+      fd = f.fileno()
+      start = offset
+      while count > 0:
+        try:
+          sent = sendfile.sendfile(sock, fd, offset, count)
+        except OSError, e:
+          if e.errno == errno.EAGAIN:
+            # the socket has a timeout, so it is non-blocking underneath
+            if not select.select([ ], [sock], [ ],
+                                 self.connection.gettimeout())[1]:
+              raise socket.timeout('timed out')
+            continue
+          if e.errno == errno.EINTR:
+            continue
+          if e.errno == errno.EPIPE or e.errno == errno.ECONNRESET:
+            raise ClientAbortedException
+          if (e.errno == errno.EINVAL or e.errno == errno.ENOSYS) \
+             and offset == start:
+            # not supported for this file; nothing was sent yet
+            break
+          raise
+        if not sent:
+          # the file shrank
+          return
+        offset = offset + sent
+        count = count - sent
+      else:
+        return
 
-    while 1:
-      data = f.read(8192)
+    f.seek(offset)
+    while count > 0:
+      data = f.read(min(count, 65536))
       if not data:
         break
-      try:
-        self.wfile.write(data)
-      except ClientAbortedException:
-        self.log_message('client closed connection for "%s"', self.path)
-        break
-      except socket.error:
-        # it was probably closed on the other end
-        break
-
-    if type == 'application/zip':
-      self.server.zipsize -= clen
+      self.wfile.write(data)
+      count = count - len(data)
 
   def build_url(self, url, file=''):
     host = self.server.name_prefix or self.headers.getheader('host') or self.server.server_name
@@ -932,13 +1993,15 @@ class EdnaRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
   def redirect(self, url):
     "Send a redirect to the specified URL."
     self.log_error("code 301 -- Moved")
+    body = self.error_message_format % {'code': 301,
+                                        'message': 'Moved',
+                                        'explain': 'Object moved permanently'}
     self.send_response(301, 'Moved')
     self.send_header('Location', url)
+    self.send_header('Content-Type', self.error_content_type)
+    self.send_header('Content-Length', len(body))
     self.end_headers()
-    self.wfile.write(self.error_message_format %
-                     {'code': 301,
-                      'message': 'Moved',
-                      'explain': 'Object moved permanently'})
+    self.wfile.write(body)
 
   def log_request(self, code='-', size='-'):
     try:
@@ -947,6 +2010,13 @@ class EdnaRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       # sometimes, we get an error before self.path exists
       self.log_message('<unknown URL> %s', code)
 
+  def log_error(self, format, *args):
+    if getattr(self, 'idle', 0):
+      # a kept-alive connection timed out waiting for the next request;
+      # nothing worth logging
+      return
+    self.log_message(format, *args)
+
   def log_message(self, format, *args):
     if not self.server.log:
       return
@@ -987,8 +2057,9 @@ class _SocketWriter:
 
   def write(self, buf):
     try:
-      s_buf = str(buf)
-      return self.wfile.write(s_buf)
+      if not isinstance(buf, str):
+        buf = str(buf)
+      return self.wfile.write(buf)
     except IOError, v:
       if v.errno == 32 or v.errno == 104:
         raise ClientAbortedException
@@ -997,6 +2068,44 @@ class _SocketWriter:
         # re-raise the error
         raise
 
+class _ChunkedWriter:
+  """Write to 'wfile' using the chunked transfer coding.  A template writes
+  a piece at a time, so the pieces are collected into chunks: the first
+  one goes out once it has 'first' bytes, so the client can start on the
+  page early, the others when they have 'size' bytes.  'written' counts
+  the bytes sent so far, and if 'keep' is a list, the chunks are appended
+  to it as they are sent.  close() sends the last chunk, but doesn't close
+  'wfile'."""
+  def __init__(self, wfile, first=4096, size=65536, keep=None):
+    self.wfile = wfile
+    self.keep = keep
+    self.limit = first
+    self.size = size
+    self.pieces = [ ]
+    self.buffered = 0
+    self.written = 0
+
+  def write(self, data):
+    self.pieces.append(data)
+    self.buffered = self.buffered + len(data)
+    if self.buffered >= self.limit:
+      self.flush()
+
+  def flush(self):
+    if self.buffered:
+      data = string.join(self.pieces, '')
+      self.pieces = [ ]
+      self.buffered = 0
+      self.limit = self.size
+      self.written = self.written + len(data)
+      if self.keep is not None:
+        self.keep.append(data)
+      self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+
+  def close(self):
+    self.flush()
+    self.wfile.write('0\r\n\r\n')
+
 class ClientAbortedException(Exception):
   pass
 
@@ -1016,9 +2125,17 @@ class empty_delegator:
 
 
 class FileInfo:
-  """Grab as much info as you can from the file given"""
+  """Grab as much info as you can from the file given.  If a MetaCache
+  is given, it is consulted first and updated after parsing the file."""
+
+  def __init__(self, fullpath, cache=None):
+    if cache is not None:
+      st = os.stat(fullpath)
+      info = cache.lookup(fullpath, st)
+      if info is not None:
+        self.__dict__.update(info)
+        return
 
-  def __init__(self, fullpath):
     base, ext = os.path.splitext(fullpath)
     ext = string.lower(ext)
 
@@ -1046,7 +2163,9 @@ class FileInfo:
                                      int(self.total_time) % 60)
     else:
       self.duration ='%02d' % int(self.total_time)
-    
+
+    if cache is not None:
+      cache.store(fullpath, st, self.__dict__)
     
 class OggInfo:
   """Extra information about an Ogg Vorbis file.
@@ -1107,14 +2226,145 @@ class OggInfo:
     self.valid = 1
 
 
-def _usable_file(fname):
-  return fname[0] != '.'
+def _hidden(name):
+  """Return true if 'name' is one of the hide_names, or contains one of
+  the hide_matching strings."""
+  name = name.lower()
+  if name in HIDE_EXACT:
+    return 1
+  for toHide in HIDE_MATCH:
+    if toHide in name:
+      return 1
+  return 0
+
+re_byte_range = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+# more ranges than this in one request are answered with the whole entity
+MAX_RANGES = 32
+
+def parse_ranges(spec, size):
+  """Parse the value of a Range header for an entity of 'size' bytes.
+  Returns a sorted list of (first, last) byte positions with overlapping
+  and adjacent ranges merged, an empty list if none of the ranges can be
+  satisfied, or None if the header should be ignored."""
+  try:
+    unit, sets = string.split(spec, '=', 1)
+  except ValueError:
+    return None
+  if string.lower(string.strip(unit)) != 'bytes':
+    return None
+
+  ranges = [ ]
+  valid = 0
+  for part in string.split(sets, ','):
+    if not string.strip(part):
+      continue
+    match = re_byte_range.match(part)
+    if not match or not (match.group(1) or match.group(2)):
+      return None
+    valid = 1
+    first, last = match.groups()
+    if first:
+      first = long(first)
+      if last:
+        last = long(last)
+        if last < first:
+          return None
+      else:
+        last = size - 1
+    else:
+      # a suffix range: the last N bytes
+      first = max(size - long(last), 0)
+      last = size - 1
+    if first < size and last >= first:
+      ranges.append((first, min(last, size - 1)))
+  if not valid:
+    return None
+
+  ranges.sort()
+  merged = [ ]
+  for first, last in ranges:
+    if merged and first <= merged[-1][1] + 1:
+      if last > merged[-1][1]:
+        merged[-1] = (merged[-1][0], last)
+    else:
+      merged.append((first, last))
+  if len(merged) > MAX_RANGES:
+    return None
+  return merged
+
+def _shutdown(conn):
+  try:
+    conn.shutdown(socket.SHUT_RDWR)
+  except socket.error:
+    pass
+
+def _drain_pipe(fd):
+  try:
+    while os.read(fd, 4096):
+      pass
+  except OSError:
+    pass
+
+def make_wakeup():
+  """Return the read end of a pipe which becomes readable whenever a
+  signal arrives (the self-pipe trick), so that a select() loop notices
+  signals right away.  Returns None where that isn't possible."""
+  if signalSupport != 'yes' or not hasattr(signal, 'set_wakeup_fd') \
+     or not hasattr(os, 'pipe'):
+    return None
+  try:
+    import fcntl
+  except ImportError:
+    return None
+  r, w = os.pipe()
+  for fd in (r, w):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+  signal.set_wakeup_fd(w)
+  return r
+
+def _mtime(fname):
+  try:
+    return os.stat(fname).st_mtime
+  except OSError:
+    return None
 
 def sort_dir(d):
   l = filter(_usable_file, os.listdir(d))
   l.sort()
   return l
 
+def _listing(path, recursive, files):
+  """List a directory for make_list(): the (name, mode) of each entry, in
+  order, where mode is None if the entry can't be stat()ed, and the
+  subdirectories to walk.  With 'files', the names hidden from the pages
+  are left out."""
+  listing = [ ]
+  subdirs = [ ]
+  entries = filter(lambda entry: _usable_file(entry[0]), list_dir(path))
+  for name, mode, is_link in entries:
+    if files and _hidden(name):
+      continue
+    listing.append((name, mode))
+    if recursive and is_dir(mode):
+      subdirs.append(name)
+  return listing, subdirs, len(entries)
+
+def _flatten(l):
+  "Return the items of the list 'l' and of the lists in it, in order."
+  result = [ ]
+  stack = [ iter(l) ]
+  while stack:
+    for item in stack[-1]:
+      if type(item) is ListType:
+        stack.append(iter(item))
+        break
+      result.append(item)
+    else:
+      stack.pop()
+  return result
+
 def dot2int(dotaddr):
   a, b, c, d = map(int, string.split(dotaddr, '.'))
   return (a << 24) + (b << 16) + (c << 8) + (d << 0)
@@ -1199,22 +2449,161 @@ def run_server(fname):
     svr.log_message('edna: Ogg Vorbis support disabled, to enable it you will need to install the "pyogg" and the "pyvorbis" modules')
 
   svr.log_message("edna: serving on port %d..." % svr.port)
+  wakeup = make_wakeup()
+  if svr.processes > 1 and hasattr(os, 'fork'):
+    run_prefork(fname, svr, wakeup)
+
+  svr.start_workers()
   try:
     while running:
-#      print 'waiting ... '
       if config_needed:
         svr.log_message('edna: Reloading config %s' % fname)
+        new = Server(fname, svr)
         svr.server_close()
-        svr = Server(fname)
+        svr = new
+        svr.start_workers()
         config_needed  = None
-      svr.handle_request()
+      svr.serve(wakeup)
     svr.log_message ("edna: exiting")
   except KeyboardInterrupt:
     print "\nCaught ctr-c, taking down the server"
-    print "Please wait while the remaining streams finish.."
+  shutdown(svr, svr.shutdown_timeout)
+  sys.exit(0)
+
+def shutdown(svr, timeout):
+  """Stop accepting connections and give the ones being served 'timeout'
+  seconds (or as long as they take, if None) to finish."""
+  svr.stop_serving()
+  count = cut = 0
+  try:
+    # not worth mentioning those that finish right away, like the idle ones
+    count = svr.drain(0.5)
+    if count:
+      if timeout is None:
+        svr.log_message("edna: waiting for %d connections to finish" % count)
+      else:
+        svr.log_message("edna: waiting up to %d seconds for %d connections "
+                        "to finish" % (timeout, count))
+      cut = svr.drain(timeout)
+  except KeyboardInterrupt:
+    cut = svr.in_flight()
+  if cut:
+    svr.log_message("edna: cut off %d of %d connections"
+                    % (cut, max(cut, count)))
+  elif count:
+    svr.log_message("edna: all connections finished")
+
+def run_prefork(fname, svr, wakeup):
+  """Serve with svr.processes worker processes, forked from this one, which
+  accept connections on the socket it bound.  This process (the supervisor)
+  keeps the filename cache and metadata cache up to date, which the workers
+  pick up from the files, and restarts workers which die.  On SIGHUP it
+  reloads the configuration and replaces the workers; the old ones finish
+  the requests they are handling first."""
+  global running, config_needed
+  workers = { }
+  next_save = time.time() + SNAPSHOT_INTERVAL
+  try:
+    while running:
+      if config_needed:
+        config_needed = None
+        svr.log_message('edna: Reloading config %s' % fname)
+        for pid in workers.keys():
+          _kill(pid, signal.SIGHUP)
+        workers = { }
+        new = Server(fname, svr)
+        svr.server_close()
+        svr = new
+
+      while len(workers) < svr.processes:
+        pid = os.fork()
+        if pid == 0:
+          run_worker(svr, wakeup)
+        workers[pid] = 1
+
+      # wake up for signals, and every second to look after the workers
+      if wakeup is not None:
+        try:
+          if select.select([wakeup], [ ], [ ], 1)[0]:
+            _drain_pipe(wakeup)
+        except select.error:
+          pass
+      else:
+        time.sleep(1)
+
+      while 1:
+        try:
+          pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError:
+          break
+        if not pid:
+          break
+        if workers.has_key(pid):
+          del workers[pid]
+          svr.log_message("edna: worker %d died (status %d), starting another"
+                          % (pid, status))
+
+      if svr.snapshot_file and svr.filename_cache_dirty \
+         and time.time() >= next_save:
+        # let the workers see what the watcher changed
+        svr.filename_cache_lock.acquire()
+        try:
+          svr.filename_cache_save()
+        finally:
+          svr.filename_cache_lock.release()
+        next_save = time.time() + SNAPSHOT_INTERVAL
+    svr.log_message ("edna: exiting")
+  except KeyboardInterrupt:
+    print "\nCaught ctr-c, taking down the server"
+  for pid in workers.keys():
+    _kill(pid, signal.SIGTERM)
+  for pid in workers.keys():
+    try:
+      os.waitpid(pid, 0)
+    except OSError:
+      pass
   svr.server_close()
   sys.exit(0)
 
+def run_worker(svr, wakeup):
+  """The main loop of a worker process forked by run_prefork.  On SIGTERM
+  it stops accepting connections and gives the ones it has shutdown_timeout
+  seconds to finish; on SIGHUP it waits for them as long as they take.
+  Never returns."""
+  global running, config_needed
+  running = 1
+  config_needed = None
+  status = 0
+  try:
+    try:
+      # a pipe of our own, signals to the supervisor are no concern of ours
+      if wakeup is not None:
+        os.close(wakeup)
+        os.close(signal.set_wakeup_fd(-1))
+        wakeup = make_wakeup()
+      svr.after_fork()
+      svr.start_workers()
+      # all of the workers wait for the same socket; only one of them gets
+      # each connection, the others must not block in accept()
+      svr.socket.setblocking(0)
+      svr.serve(wakeup)
+      if running:
+        shutdown(svr, None)
+      else:
+        shutdown(svr, svr.shutdown_timeout)
+    except KeyboardInterrupt:
+      pass
+  except:
+    traceback.print_exc()
+    status = 1
+  os._exit(status)
+
+def _kill(pid, sig):
+  try:
+    os.kill(pid, sig)
+  except OSError:
+    pass
+
 def usage():
       print 'USAGE: %s [--daemon] [config-file]' % os.path.basename(sys.argv[0])
       print '  if config-file is not specified, then edna.conf is used'
@@ -31,6 +31,7 @@
 #    http://edna.sourceforge.net/
 #
 
+import os
 import string
 import re
 from types import StringType, IntType, FloatType, UnicodeType
@@ -41,18 +42,37 @@ _re_parse = re.compile('(\[[-\w.# ]+\])|(\[\[\])')
 _block_cmd_specs = { 'if-any':1, 'if-index':2, 'for':1 }
 _block_cmds = _block_cmd_specs.keys()
 
+# file name -> (mtime, program, render function) of the templates parsed
+# so far, so that a config reload doesn't compile them again
+_compiled = { }
+
+# tuple of encodings -> _Converter, shared by the templates using them
+_converters = { }
+
+# how many decoded strings a _Converter remembers (per generation)
+DECODE_CACHE_SIZE = 5000
+
 class Template:
 
   def __init__(self, fname, encodingslist):
+    encodings = tuple(encodingslist)
+    converter = _converters.get(encodings)
+    if converter is None:
+      converter = _converters[encodings] = _Converter(encodings)
+    self.convert = converter.convert
     if fname:
       self.parse_file(fname)
-    global encodings
-    encodings = encodingslist
 
   def parse_file(self, fname):
-    self.parse(open(fname).read())
+    mtime = os.stat(fname).st_mtime
+    cached = _compiled.get(fname)
+    if cached is not None and cached[0] == mtime:
+      self.program, self._render = cached[1:]
+      return
+    self.parse(open(fname).read(), fname)
+    _compiled[fname] = (mtime, self.program, self._render)
 
-  def parse(self, text):
+  def parse(self, text, fname='<template>'):
     # parse the program into: (TEXT DIRECTIVE BRACKET)* TEXT
     # DIRECTIVE will be '[directive]' or None
     # BRACKET will be '[[]' or None
@@ -93,8 +113,7 @@ class Template:
           # note: true-section may be None
           cmd, idx, args, true_section = stack.pop()
           else_section = program[idx:]
-          func = getattr(self, '_cmd_' + re.sub('-', '_', cmd))
-          program[idx:] = [ (func, (args, true_section, else_section)) ]
+          program[idx:] = [ (cmd, (args, true_section, else_section)) ]
         elif cmd in _block_cmds:
           if len(args) > _block_cmd_specs[cmd] + 1:
             raise ArgCountSyntaxError()
@@ -106,100 +125,190 @@ class Template:
           # implied PRINT command
           if len(args) > 1:
             raise ArgCountSyntaxError()
-          program.append((self._cmd_print, _prepare_ref(args[0])))
+          program.append(('print', _prepare_ref(args[0])))
 
     self.program = program
+    self._render = _Compiler().compile(program, fname)
 
   def generate(self, fp, data):
-    ctx = _context()
-    ctx.data = data
-    ctx.for_index = { }
-    self._execute(self.program, fp, ctx)
+    self._render(fp.write, data, self.convert)
+
+
+class _Compiler:
+  """
+  Turns a parsed program into a Python function, render(write, data,
+  _convert), which writes what the program describes.  Walking the
+  program for every page meant a type check and a method call for each
+  step, and a search of the loop variables and the data for each
+  reference; in the generated code the text between directives is a
+  constant, and a reference is a local variable (the current item of an
+  enclosing [for]) or a lookup in 'data', followed by plain attribute
+  accesses.
+  """
+
+  def __init__(self):
+    self.lines = [ ]
+    self.loops = [ ]    # enclosing [for]s: (refname, list, index, item)
+    self.count = 0
+
+  def compile(self, program, fname):
+    self.emit(0, 'def render(write, data, _convert):')
+    self.block(program, 1)
+    code = compile(string.join(self.lines, '\n') + '\n', fname, 'exec')
+    namespace = { 'StringType': StringType,
+                  'UnknownReference': UnknownReference,
+                  'NeedSequenceError': NeedSequenceError }
+    exec code in namespace
+    return namespace['render']
 
-  def _execute(self, program, fp, ctx):
+  def emit(self, depth, line):
+    self.lines.append('  ' * depth + line)
+
+  def block(self, program, depth):
+    start = len(self.lines)
+    text = [ ]
     for step in program:
       if isinstance(step, StringType):
-        fp.write(step)
-      else:
-        step[0](step[1], fp, ctx)
+        text.append(step)
+        continue
+      if text:
+        self.emit(depth, 'write(%s)' % repr(string.join(text, '')))
+        text = [ ]
+      cmd, args = step
+      getattr(self, '_cmd_' + re.sub('-', '_', cmd))(args, depth)
+    if text:
+      self.emit(depth, 'write(%s)' % repr(string.join(text, '')))
+    if len(self.lines) == start:
+      self.emit(depth, 'pass')
+
+  def value(self, (refname, ref), depth):
+    """Emit code which sets _v to the value of a reference."""
+    for loop in self.loops[::-1]:
+      if loop[0] == ref[0]:
+        self.emit(depth, '_v = %s' % loop[3])
+        break
+    else:
+      self.emit(depth, 'try:')
+      self.emit(depth + 1, '_v = data[%s]' % repr(ref[0]))
+      self.emit(depth, 'except KeyError:')
+      self.emit(depth + 1, 'raise UnknownReference(%s)' % repr(refname))
+    if len(ref) > 1:
+      self.emit(depth, 'try:')
+      # a part needn't be a Python identifier ([x.class], [a.b-c])
+      for part in ref[1:]:
+        self.emit(depth + 1, '_v = getattr(_v, %s)' % repr(part))
+      self.emit(depth, 'except AttributeError:')
+      self.emit(depth + 1, 'raise UnknownReference(%s)' % repr(refname))
 
-  def _cmd_print(self, (refname, ref), fp, ctx):
-    ### type check the value
-    fp.write(_get_value(refname, ref, ctx))
+  def _cmd_print(self, ref, depth):
+    self.value(ref, depth)
+    self.emit(depth, 'write(_convert(_v))')
 
-  def _cmd_if_any(self, args, fp, ctx):
+  def _cmd_if_any(self, args, depth):
     "If the value is a non-empty string or non-empty list, then T else F."
-    (((refname, ref),), t_section, f_section) = args
-    value = _get_value(refname, ref, ctx)
-    self._do_if(value, t_section, f_section, fp, ctx)
+    ((ref,), t_section, f_section) = args
+    self.value(ref, depth)
+    self._do_if('_convert(_v)', t_section, f_section, depth)
 
-  def _cmd_if_index(self, args, fp, ctx):
+  def _cmd_if_index(self, args, depth):
     (((refname, ref), value), t_section, f_section) = args
-    list, idx = ctx.for_index[refname]
+    for loop in self.loops[::-1]:
+      if loop[0] == refname:
+        break
+    else:
+      # not inside a [for] over it
+      self.emit(depth, 'raise KeyError(%s)' % repr(refname))
+      return
+    list, idx = loop[1:3]
     if value == 'even':
-      value = idx % 2 == 0
+      cond = '%s %% 2 == 0' % idx
     elif value == 'odd':
-      value = idx % 2 == 1
+      cond = '%s %% 2 == 1' % idx
     elif value == 'last':
-      value = idx == len(list)-1
+      cond = '%s == len(%s)-1' % (idx, list)
     else:
-      value = idx == int(value)
-    self._do_if(value, t_section, f_section, fp, ctx)
+      cond = '%s == int(%s)' % (idx, repr(value))
+    self._do_if(cond, t_section, f_section, depth)
 
-  def _do_if(self, value, t_section, f_section, fp, ctx):
+  def _do_if(self, cond, t_section, f_section, depth):
     if t_section is None:
       t_section = f_section
       f_section = None
-    if value:
-      section = t_section
-    else:
-      section = f_section
-    if section is not None:
-      self._execute(section, fp, ctx)
+    self.emit(depth, 'if %s:' % cond)
+    self.block(t_section, depth + 1)
+    if f_section is not None:
+      self.emit(depth, 'else:')
+      self.block(f_section, depth + 1)
 
-  def _cmd_for(self, args, fp, ctx):
+  def _cmd_for(self, args, depth):
     (((refname, ref),), unused, section) = args
-    list = _get_value(refname, ref, ctx)
-    if isinstance(list, StringType):
-      raise NeedSequenceError()
-    ctx.for_index[refname] = [ list, 0 ]
-    for i in range(len(list)):
-      ctx.for_index[refname][1] = i
-      self._execute(section, fp, ctx)
-    del ctx.for_index[refname]
+    self.count = self.count + 1
+    list, idx, item = '_l%d' % self.count, '_i%d' % self.count, \
+                      '_o%d' % self.count
+    self.value((refname, ref), depth)
+    self.emit(depth, '%s = _convert(_v)' % list)
+    self.emit(depth, 'if isinstance(%s, StringType):' % list)
+    self.emit(depth + 1, 'raise NeedSequenceError()')
+    self.emit(depth, 'for %s in range(len(%s)):' % (idx, list))
+    self.emit(depth + 1, '%s = %s[%s]' % (item, list, idx))
+    self.loops.append((refname, list, idx, item))
+    self.block(section, depth + 1)
+    self.loops.pop()
 
 
 def _prepare_ref(refname):
   return refname, string.split(refname, '.')
 
-def _get_value(refname, ref, ctx):
-  if ctx.for_index.has_key(ref[0]):
-    list, idx = ctx.for_index[ref[0]]
-    ob = list[idx]
-  elif ctx.data.has_key(ref[0]):
-    ob = ctx.data[ref[0]]
-  else:
-    raise UnknownReference(refname)
-
-  # walk the dotted ref
-  for attr in ref[1:]:
-    try:
-      ob = getattr(ob, attr)
-    except AttributeError:
-      raise UnknownReference(refname)
-
-  if ob is None:
-    return ''
-
-  # make sure we return a UTF-8 string.  ### other types?
-  if isinstance(ob, IntType) or isinstance(ob, FloatType):
-    return unicode(ob).encode('UTF-8')
-  if isinstance(ob, UnicodeType):
-    return ob.encode('UTF-8')
-  if isinstance(ob, StringType):
+class _Converter:
+  """
+  Turns the values of references into what a template prints: UTF-8
+  strings, or the value itself for anything that isn't a string or a
+  number (the sequences of [for]).  Byte strings are decoded with the
+  first of 'encodings' that fits.
+
+  The same names are printed on every page view and search, so decoded
+  strings are remembered.  There are two generations of them: when the
+  current one is full it becomes the previous one, and the strings which
+  are found there are moved back into the current one, so the cache is
+  bounded and keeps what is in use.
+  """
+
+  def __init__(self, encodings, size=DECODE_CACHE_SIZE):
+    self.encodings = encodings
+    self.size = size
+    self.recent = { }
+    self.older = { }
+
+  def convert(self, ob):
+    if isinstance(ob, StringType):
+      try:
+        return self.recent[ob]
+      except KeyError:
+        pass
+      value = self.older.get(ob)
+      if value is None:
+        value = self.decode(ob)
+      recent = self.recent
+      if len(recent) >= self.size:
+        self.older = recent
+        recent = self.recent = { }
+      recent[ob] = value
+      return value
+
+    if ob is None:
+      return ''
+
+    # make sure we return a UTF-8 string.  ### other types?
+    if isinstance(ob, IntType) or isinstance(ob, FloatType):
+      return unicode(ob).encode('UTF-8')
+    if isinstance(ob, UnicodeType):
+      return ob.encode('UTF-8')
+    return ob
+
+  def decode(self, ob):
     unob = None
     # Try to decode using the list of possible encodings given
-    for encoding in encodings:
+    for encoding in self.encodings:
       try:
         unob = unicode(ob, encoding, 'strict')
         break
@@ -209,15 +318,10 @@ def _get_value(refname, ref, ctx):
     if unob is None:
       # Decoding failed with all of the suggested encodings,
       # Decode again with the last encoding and ignore errors.
-      unob = unicode(ob, encodings[-1], 'replace')
+      unob = unicode(ob, self.encodings[-1], 'replace')
 
     return unob.encode('UTF-8')
 
-  return ob
-
-class _context:
-  pass
-
 class ArgCountSyntaxError(Exception):
   pass
 
@@ -0,0 +1,293 @@
+#
+# filecache.py -- cached listing of the source directories for edna
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+import os
+import string
+import time
+from array import array
+
+from walker import Walker, list_dir, is_dir, join
+
+# a directory modified less than this many seconds before we look at it
+# may change again within the resolution of its mtime; don't trust it.
+MTIME_SLACK = 2
+
+
+class FilenameCache:
+  """
+  The names of the files and directories below the source directories,
+  remembered per directory along with the directory's mtime.
+
+  entries() returns them as a list of tuples containing the source's
+  display name, the relative path from the source directory to the file,
+  and the filename.  Path separators are translated to "/", and the
+  names of directories end with "/".  It's important that this collects
+  *everything* that the search needs to qualify search results, or
+  searches would have to hit the filesystem, which is what we're trying
+  to avoid.
+
+  Adding or removing an entry changes the mtime of its directory, so an
+  incremental refresh only needs to stat() each known directory and list
+  the ones that changed.  A full refresh lists everything again.  The
+  trees are walked by a Walker, within its limits.
+
+  All of the names are kept in one character array, the name store: the
+  names of a directory follow each other, separated by NULs, and its
+  entry holds a buffer over them.  A directory listed again gets its
+  names added at the end; refresh() compacts the store once most of it
+  is out of date.  The SearchIndex refers to the names in the store
+  rather than keeping them again.
+  """
+
+  def __init__(self):
+    self.dirs = { }     # (rootname, reldir) -> (mtime, names, subdirs)
+                        # with the names a buffer over the store
+    self.roots = [ ]    # (rootdir, rootname)
+    self.generation = 0 # incremented by every refresh()
+    self.store = array('c')
+
+  def refresh(self, roots, incremental=1, log=None, max_depth=None,
+              max_entries=None):
+    """Bring the cache up to date with the (directory, display name) pairs
+    in 'roots'.  Returns the number of directories that had to be listed.
+    The trees are walked within 'max_depth' and 'max_entries' (see
+    Walker); directories the walk skips are reported to log(), if
+    given."""
+    dirs = { }
+    listed = 0
+    for rootdir, rootname in roots:
+      walker = Walker(max_depth, max_entries, log)
+      listdir = lambda path, reldir, st, self=self, rootname=rootname, \
+                       incremental=incremental: \
+                  self._listing(rootname, reldir, path, st, incremental)
+      for path, reldir, st, entry in walker.walk(rootdir, listdir):
+        key = (rootname, reldir)
+        if entry is not self.dirs.get(key):
+          listed = listed + 1
+        dirs[key] = entry
+
+    used = 0
+    for mtime, names, subdirs in dirs.values():
+      used = used + len(names) + 1
+    if used < len(self.store) / 2:
+      self._compact(dirs)
+    self.dirs, self.roots = dirs, list(roots)
+    self.generation = self.generation + 1
+    return listed
+
+  def _compact(self, dirs):
+    """Copy the names of the entries in 'dirs' to a new store, leaving out
+    those of directories that were listed again or forgotten since.  The
+    old store stays valid for those still using its entries."""
+    store = array('c')
+    for key, (mtime, names, subdirs) in dirs.items():
+      start = len(store)
+      store.fromstring(names[:] + '\0')
+      dirs[key] = (mtime, buffer(store, start, len(names)), subdirs)
+    self.store = store
+
+  def _listing(self, rootname, reldir, path, st, incremental):
+    """List a directory for a Walker.  The cache entry it had is kept if
+    the directory hasn't changed since, and 'incremental' is true."""
+    mtime = st.st_mtime
+    old = self.dirs.get((rootname, reldir))
+    if incremental and old and old[0] is not None and old[0] == mtime:
+      return old, old[2], _count(old[1])
+    names, subdirs = _names(list_dir(path))
+    if time.time() - mtime < MTIME_SLACK:
+      mtime = None
+    return (mtime, self._pack(names), tuple(subdirs)), subdirs, len(names)
+
+  def update(self, rootname, reldir, max_depth=None, max_entries=None):
+    """List one directory that is known to have changed again, along with
+    any directories that appeared below it (within 'max_depth' and
+    'max_entries').  Returns two lists of entries (in the form returned
+    by entries()): those added and those removed."""
+    key = (rootname, reldir)
+    old = self.dirs.get(key)
+    if old is None:
+      # not known (yet); updating its parent will pick it up
+      return [ ], [ ]
+    path = self.path(rootname, reldir)
+    try:
+      mtime = os.stat(path).st_mtime
+      names, subdirs = _names(list_dir(path))
+    except OSError:
+      # gone; updating its parent will drop it
+      return [ ], [ ]
+    if time.time() - mtime < MTIME_SLACK:
+      mtime = None
+
+    added = [ ]
+    removed = [ ]
+    oldnames = _set(_unpack(old[1]))
+    newnames = _set(names)
+    for name in oldnames.keys():
+      if not newnames.has_key(name):
+        removed.append((rootname, reldir, name))
+    for name in names:
+      if not oldnames.has_key(name):
+        added.append((rootname, reldir, name))
+
+    oldsubdirs = _set(old[2])
+    newsubdirs = _set(subdirs)
+    for name in old[2]:
+      if not newsubdirs.has_key(name):
+        self._forget(rootname, join(reldir, name), removed)
+    for name in subdirs:
+      if not oldsubdirs.has_key(name):
+        self._scan(os.path.join(path, name), rootname, join(reldir, name),
+                   added, Walker(max_depth, max_entries))
+
+    self.dirs[key] = (mtime, self._pack(names), tuple(subdirs))
+    return added, removed
+
+  def _scan(self, path, rootname, reldir, added, walker):
+    """Add a directory (and everything below it) that is new to the cache."""
+    listdir = lambda path, reldir, st, self=self, rootname=rootname: \
+                self._listing(rootname, reldir, path, st, 0)
+    for path, reldir, st, entry in walker.walk(path, listdir, reldir):
+      self.dirs[(rootname, reldir)] = entry
+      for name in _unpack(entry[1]):
+        added.append((rootname, reldir, name))
+
+  def _forget(self, rootname, reldir, removed):
+    """Drop a directory (and everything below it) from the cache."""
+    try:
+      mtime, names, subdirs = self.dirs[(rootname, reldir)]
+    except KeyError:
+      return
+    del self.dirs[(rootname, reldir)]
+    for name in _unpack(names):
+      removed.append((rootname, reldir, name))
+    for name in subdirs:
+      self._forget(rootname, join(reldir, name), removed)
+
+  def _pack(self, names):
+    "Add 'names' to the store, and return a buffer over them."
+    start = len(self.store)
+    packed = string.join(names, '\0')
+    self.store.fromstring(packed + '\0')
+    return buffer(self.store, start, len(packed))
+
+  def retain(self, roots):
+    """Forget everything below the source directories which aren't among
+    the (directory, display name) pairs in 'roots'."""
+    keep = filter(lambda root: root in roots, self.roots)
+    names = { }
+    for rootdir, rootname in keep:
+      names[rootname] = None
+    for key in self.dirs.keys():
+      if not names.has_key(key[0]):
+        del self.dirs[key]
+    self.roots = keep
+    self.generation = self.generation + 1
+
+  def path(self, rootname, reldir):
+    """Return the filesystem path of a directory in the cache."""
+    for rootdir, name in self.roots:
+      if name == rootname:
+        break
+    else:
+      raise KeyError(rootname)
+    if not reldir:
+      return rootdir
+    return os.path.join(rootdir, string.replace(reldir, '/', os.sep))
+
+  def locate(self, path):
+    """Return the (rootname, reldir) key of the directory 'path', if it
+    is below one of the source directories, or None.  The directory may
+    not be in the cache (yet)."""
+    path = os.path.normpath(path)
+    for rootdir, rootname in self.roots:
+      rootdir = os.path.normpath(rootdir)
+      if path == rootdir:
+        return rootname, ''
+      if path[:len(rootdir) + 1] == rootdir + os.sep:
+        return rootname, string.replace(path[len(rootdir) + 1:], os.sep, '/')
+    return None
+
+  def walk(self):
+    """Generate the (rootname, reldir) key and the entry of each directory,
+    top-down."""
+    dirs = self.dirs
+    for rootdir, rootname in self.roots:
+      stack = [ '' ]
+      while stack:
+        reldir = stack.pop()
+        try:
+          entry = dirs[(rootname, reldir)]
+        except KeyError:
+          continue
+        yield (rootname, reldir), entry
+        subdirs = list(entry[2])
+        subdirs.reverse()
+        for name in subdirs:
+          stack.append(join(reldir, name))
+
+  def entries(self):
+    """Return a list of (rootname, reldir, name) tuples, top-down."""
+    entries = [ ]
+    for (rootname, reldir), entry in self.walk():
+      for name in _unpack(entry[1]):
+        entries.append((rootname, reldir, name))
+    return entries
+
+  def __len__(self):
+    count = 0
+    for mtime, names, subdirs in self.dirs.values():
+      if names:
+        count = count + _count(names)
+    return count
+
+  def directories(self):
+    return len(self.dirs)
+
+
+def _names(listing):
+  """Return the names in a directory listing, with "/" appended to the
+  names of directories, and the subset of directories which should be
+  descended into (symbolic links are not)."""
+  names = [ ]
+  subdirs = [ ]
+  for name, mode, is_link in listing:
+    if is_dir(mode):
+      names.append(name + '/')
+      if not is_link:
+        subdirs.append(name)
+    else:
+      names.append(name)
+  return names, subdirs
+
+def _unpack(names):
+  # filenames can't contain NULs
+  if not names:
+    return [ ]
+  return string.split(names[:], '\0')
+
+def _count(names):
+  "Return the number of names in 'names'."
+  if not names:
+    return 0
+  return string.count(names[:], '\0') + 1
+
+def _set(names):
+  d = { }
+  for name in names:
+    d[name] = None
+  return d
@@ -0,0 +1,367 @@
+#
+# metacache.py -- persistent cache of song information for edna
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+import os
+import stat
+import string
+import time
+import marshal
+import threading
+import Queue
+from types import StringType, UnicodeType, IntType, LongType, FloatType, \
+                  NoneType, TupleType
+
+from walker import Walker, list_dir, is_dir
+
+# the first record of every cache file; bump the version whenever the
+# layout of the records (or what FileInfo puts in them) changes.
+MAGIC = 'edna-metacache'
+VERSION = 1
+
+# rewrite the file on open when it holds more than this many records
+# that have been superseded by newer ones (and they outnumber the live ones)
+COMPACT_THRESHOLD = 1000
+
+# how often (in seconds) the Indexer reads what other processes appended
+UPDATE_INTERVAL = 1
+
+_plain_types = (StringType, UnicodeType, IntType, LongType, FloatType,
+                NoneType)
+
+
+class MetaCache:
+  """
+  A persistent map from the path of a song to the information FileInfo
+  extracted from it.  Each entry remembers the size and mtime the file had
+  when it was parsed; a lookup with a stat() result that doesn't match
+  misses, so changed files are parsed again and simply re-stored.
+
+  New entries are appended to the cache file as marshalled records.  When
+  the cache is opened the file is replayed (later records win) and, if it
+  has accumulated too many superseded records, rewritten compactly.
+
+  Several processes may append to the same file; update() reads the
+  records the others appended since the file was last read.
+
+  edna keeps the ZIP manifests of directories in the same cache, under
+  the path of the directory; a directory's size and mtime change when a
+  file is added, removed or renamed in it.
+  """
+
+  def __init__(self, fname):
+    self.fname = fname
+    self.entries = { }
+    self.lock = threading.Lock()
+    self.hits = self.misses = 0
+
+    stale = self._load()
+    if stale is None or (stale > COMPACT_THRESHOLD
+                         and stale > len(self.entries)):
+      self._rewrite()
+    self.fp = open(fname, 'ab')
+    self.loaded = os.fstat(self.fp.fileno()).st_size
+
+  def _load(self):
+    """Replay the cache file.  Returns the number of superseded records,
+    or None if the file is missing, damaged or of another version."""
+    try:
+      fp = open(self.fname, 'rb')
+    except IOError:
+      return None
+    stale = 0
+    try:
+      try:
+        if marshal.load(fp) != (MAGIC, VERSION):
+          return None
+        while 1:
+          path, size, mtime, info = marshal.load(fp)
+          if self.entries.has_key(path):
+            stale = stale + 1
+          self.entries[path] = (size, mtime, info)
+      except EOFError:
+        pass
+      except (ValueError, TypeError):
+        # a partially written record at the end (or garbage); keep what
+        # we've got and write it out again cleanly.
+        return None
+    finally:
+      fp.close()
+    return stale
+
+  def _rewrite(self):
+    tmpname = self.fname + '.tmp'
+    fp = open(tmpname, 'wb')
+    marshal.dump((MAGIC, VERSION), fp)
+    for path, (size, mtime, info) in self.entries.items():
+      if size is not None:
+        marshal.dump((path, size, mtime, info), fp)
+    fp.close()
+    if os.name != 'posix' and os.path.exists(self.fname):
+      # rename() won't replace an existing file on Windows
+      os.remove(self.fname)
+    os.rename(tmpname, self.fname)
+
+  def update(self):
+    """Read the records appended to the cache file since it was last read.
+    A record which is still being written is left for the next update."""
+    try:
+      fp = open(self.fname, 'rb')
+    except IOError:
+      return
+    try:
+      if os.fstat(fp.fileno()).st_size <= self.loaded:
+        return
+      fp.seek(self.loaded)
+      while 1:
+        try:
+          path, size, mtime, info = marshal.load(fp)
+        except (EOFError, ValueError, TypeError):
+          break
+        self.entries[path] = (size, mtime, info)
+        self.loaded = fp.tell()
+    finally:
+      fp.close()
+
+  def lookup(self, path, st):
+    """Return the information stored for 'path', or None if there is none
+    or the file has changed since.  'st' is the file's os.stat() result."""
+    entry = self.entries.get(path)
+    if entry is not None and entry[0] == st[stat.ST_SIZE] \
+       and entry[1] == st[stat.ST_MTIME]:
+      self.hits = self.hits + 1
+      return entry[2]
+    self.misses = self.misses + 1
+    return None
+
+  def is_current(self, path, st):
+    """Like lookup(), but only says whether there is an up to date entry
+    and doesn't count as a hit or miss."""
+    entry = self.entries.get(path)
+    return entry is not None and entry[0] == st[stat.ST_SIZE] \
+           and entry[1] == st[stat.ST_MTIME]
+
+  def store(self, path, st, info):
+    """Remember the attributes in the dictionary 'info' for 'path'.  Only
+    plain values (strings, numbers and tuples of them) are kept."""
+    plain = { }
+    for key, value in info.items():
+      if _plain(value):
+        plain[key] = value
+    self._append(path, st[stat.ST_SIZE], st[stat.ST_MTIME], plain)
+
+  def forget(self, path):
+    """Drop what is stored for 'path', e.g. because the file changed in a
+    way its size and mtime don't show."""
+    self._append(path, None, None, { })
+
+  def _append(self, path, size, mtime, plain):
+    record = marshal.dumps((path, size, mtime, plain))
+    self.lock.acquire()
+    try:
+      self.entries[path] = (size, mtime, plain)
+      if self.fp:
+        try:
+          # one write per record, so concurrent appends can't interleave
+          self.fp.write(record)
+          self.fp.flush()
+        except IOError:
+          pass
+    finally:
+      self.lock.release()
+
+  def __len__(self):
+    return len(self.entries)
+
+  def close(self):
+    self.lock.acquire()
+    try:
+      if self.fp:
+        self.fp.close()
+        self.fp = None
+    finally:
+      self.lock.release()
+
+
+class Indexer:
+  """
+  Fills a MetaCache ahead of time by walking directory trees and parsing
+  every song that isn't cached yet.  run() does the walking and hands the
+  paths to a pool of worker threads; it returns when they are all done,
+  which makes it suitable as a Scheduler action.
+
+  'parse' is called as parse(path, cache) and is expected to store its
+  results in the cache (edna passes FileInfo).  Other processes may be
+  storing songs in the same cache file, so the records they appended are
+  read every UPDATE_INTERVAL seconds during a run.  'load' limits the share
+  of the time (in percent) spent parsing, added up over all workers, so
+  the indexer reads less from a slow disk than from a fast one; 0 means
+  no limit.
+  The trees are walked within 'max_depth' and 'max_entries' (see
+  Walker); directories the walk skips are reported to log(), if given.
+  """
+
+  def __init__(self, cache, parse, workers=1, load=0, log=None,
+               max_depth=None, max_entries=None):
+    self.cache = cache
+    self.parse = parse
+    self.log = log
+    self.max_depth = max_depth
+    self.max_entries = max_entries
+    self.workers = max(1, workers)
+    self.load = load
+    self.lock = threading.Lock()
+    self.stop_requested = 0
+    self.running = 0
+    self.walking = 0
+    self.started = self.finished = None
+    self.total = self.scanned = self.cached = self.errors = 0
+    self.next_slot = 0
+
+  def run(self, roots, extensions):
+    """Index every file below the directories in 'roots' whose (lowercase)
+    extension is in 'extensions'."""
+    self.stop_requested = 0
+    self.running = self.walking = 1
+    self.started = time.time()
+    self.finished = None
+    self.total = self.scanned = self.cached = self.errors = 0
+
+    todo = Queue.Queue(1000)
+    threads = [ ]
+    for i in range(self.workers):
+      t = threading.Thread(target=self._work, args=(todo,))
+      t.setDaemon(1)
+      t.start()
+      threads.append(t)
+
+    try:
+      next_update = 0
+      for root in roots:
+        if self.stop_requested:
+          break
+        walker = Walker(self.max_depth, self.max_entries, self.log)
+        for dirpath, reldir, st, filenames in walker.walk(root, _files):
+          if self.stop_requested:
+            break
+          if time.time() >= next_update:
+            self.cache.update()
+            next_update = time.time() + UPDATE_INTERVAL
+          for name in filenames:
+            if string.lower(os.path.splitext(name)[1]) in extensions:
+              self._count('total')
+              todo.put(os.path.join(dirpath, name))
+    finally:
+      self.walking = 0
+      for t in threads:
+        todo.put(None)
+      for t in threads:
+        t.join()
+      self.running = 0
+      self.finished = time.time()
+
+  def stop(self):
+    """Ask a running index to stop; the workers drop whatever is queued."""
+    self.stop_requested = 1
+
+  def _work(self, todo):
+    while 1:
+      path = todo.get()
+      if path is None:
+        return
+      if self.stop_requested:
+        continue
+      try:
+        if self.cache.is_current(path, os.stat(path)):
+          self._count('cached')
+          continue
+        self._throttle()
+        start = time.time()
+        try:
+          self.parse(path, self.cache)
+        finally:
+          self._spent(start, time.time() - start)
+        self._count('scanned')
+      except:
+        # unreadable or not really a song; it will be tried again (and
+        # fail again) when it is listed, so don't bother remembering it.
+        self._count('errors')
+
+  def _count(self, name):
+    self.lock.acquire()
+    try:
+      setattr(self, name, getattr(self, name) + 1)
+    finally:
+      self.lock.release()
+
+  def _throttle(self):
+    "Wait until the workers have rested for the time they spent parsing."
+    if self.load <= 0:
+      return
+    wait = self.next_slot - time.time()
+    if wait > 0:
+      time.sleep(wait)
+
+  def _spent(self, start, elapsed):
+    """Account for 'elapsed' seconds spent parsing a song from 'start' on.
+    The parses of the workers overlap, so each one's share of the time is
+    added up from the end of the last, not from its own end."""
+    if self.load <= 0 or self.load >= 100:
+      return
+    self.lock.acquire()
+    try:
+      self.next_slot = max(self.next_slot, start) + elapsed * 100.0 / self.load
+    finally:
+      self.lock.release()
+
+  def remaining(self):
+    return self.total - self.scanned - self.cached - self.errors
+
+  def files_per_second(self):
+    """The number of songs parsed per second during the last (or current)
+    run."""
+    if self.started is None:
+      return 0.0
+    elapsed = (self.finished or time.time()) - self.started
+    if elapsed <= 0:
+      return 0.0
+    return self.scanned / elapsed
+
+
+def _plain(value):
+  if type(value) is TupleType:
+    for item in value:
+      if not _plain(item):
+        return 0
+    return 1
+  return type(value) in _plain_types
+
+def _usable_file(fname):
+  return fname[0] != '.'
+
+def _files(path, reldir, st):
+  """List a directory for a Walker: the files in it, and the directories
+  (or symbolic links to directories) to walk."""
+  files = [ ]
+  subdirs = [ ]
+  listing = filter(lambda entry: _usable_file(entry[0]), list_dir(path))
+  for name, mode, is_link in listing:
+    if is_dir(mode):
+      subdirs.append(name)
+    else:
+      files.append(name)
+  return files, subdirs, len(listing)
@@ -0,0 +1,174 @@
+#
+# pagecache.py -- keep rendered pages in memory for edna
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+import os
+import stat
+import time
+import md5
+import threading
+
+# a file modified less than this many seconds ago may change again within
+# the resolution of its mtime; a page depending on it isn't kept.
+MTIME_SLACK = 2
+
+# the dependencies of a page are looked at no more often than this (in
+# seconds), however often it is asked for
+CHECK_INTERVAL = 1
+
+
+class Page:
+  """A rendered page, along with what it takes to tell whether it is
+  still current and to answer conditional requests for it."""
+
+  def __init__(self, key, body, content_type, deps, expires, etag=None,
+               last_modified=None):
+    self.key = key
+    self.body = body
+    self.content_type = content_type
+    self.deps = deps            # (path, mtime) pairs
+    self.expires = expires      # time after which it is stale, or None
+    if etag is None:
+      etag, last_modified = validators(key, deps)
+    self.etag = etag
+    self.last_modified = last_modified
+    self.checked = time.time()  # when the deps were last found unchanged
+    self.prev = self.next = None
+
+  def current(self):
+    now = time.time()
+    if self.expires is not None and now >= self.expires:
+      return 0
+    if now - self.checked < CHECK_INTERVAL:
+      return 1
+    for path, mtime in self.deps:
+      try:
+        if os.stat(path)[stat.ST_MTIME] != mtime:
+          return 0
+      except OSError:
+        return 0
+    self.checked = now
+    return 1
+
+
+def validators(key, deps):
+  """Return the (ETag, Last-Modified time) of a page for 'key' rendered
+  now from the (path, mtime) pairs in 'deps'.  A page can change without
+  any of its dependencies changing (what is new expires, songs are
+  retagged), so both are those of the rendering, never reused by the
+  next one; they are known before the page is, so it can be sent as it
+  is generated."""
+  now = time.time()
+  last_modified = max([ now ] + map(lambda dep: dep[1], deps))
+  etag = '"%s"' % md5.new('%r %r' % (key, now)).hexdigest()[:16]
+  return etag, last_modified
+
+
+class PageCache:
+  """
+  Rendered pages, looked up by a key chosen by the caller, up to
+  'maxbytes' bytes of page bodies.  When that is exceeded the least
+  recently used pages are dropped.
+
+  Each page is stored with the (path, mtime) pairs of the files and
+  directories it was rendered from; get() only returns it while all of
+  them still have the same mtime, and until its expiry time.  Both are
+  checked by get() (the mtimes at most every CHECK_INTERVAL seconds), so
+  nothing ever has to be invalidated.
+  """
+
+  def __init__(self, maxbytes):
+    self.maxbytes = maxbytes
+    self.size = 0
+    self.pages = { }
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    # the pages in order of use, most recent first, in a circular list
+    self.head = Page(None, '', None, (), None)
+    self.head.prev = self.head.next = self.head
+
+  def __len__(self):
+    return len(self.pages)
+
+  def get(self, key):
+    """Return the current Page for 'key', or None."""
+    self.lock.acquire()
+    try:
+      page = self.pages.get(key)
+      if page is not None:
+        self._unlink(page)
+        self._link(page)
+    finally:
+      self.lock.release()
+    if page is not None and not page.current():
+      self.lock.acquire()
+      try:
+        if self.pages.get(key) is page:
+          self._remove(page)
+      finally:
+        self.lock.release()
+      page = None
+    if page is None:
+      self.misses = self.misses + 1
+    else:
+      self.hits = self.hits + 1
+    return page
+
+  def add(self, key, body, content_type, deps, expires=None, etag=None,
+          last_modified=None):
+    """Store a page rendered from the (path, mtime) pairs in 'deps', and
+    return it as a Page.  'etag' and 'last_modified' are those it was
+    sent with, if it was (see validators()).  Pages depending on
+    something modified within MTIME_SLACK seconds, or too big for the
+    cache, are returned but not stored."""
+    page = Page(key, body, content_type, deps, expires, etag, last_modified)
+    keep = len(body) <= self.maxbytes
+    now = time.time()
+    for path, mtime in deps:
+      if now - mtime < MTIME_SLACK:
+        keep = 0
+
+    self.lock.acquire()
+    try:
+      old = self.pages.get(key)
+      if old is not None:
+        self._remove(old)
+      if keep:
+        self.pages[key] = page
+        self._link(page)
+        self.size = self.size + len(body)
+        while self.size > self.maxbytes:
+          self._remove(self.head.prev)
+    finally:
+      self.lock.release()
+    return page
+
+  def _link(self, page):
+    page.prev = self.head
+    page.next = self.head.next
+    page.next.prev = page
+    self.head.next = page
+
+  def _unlink(self, page):
+    page.prev.next = page.next
+    page.next.prev = page.prev
+
+  def _remove(self, page):
+    self._unlink(page)
+    del self.pages[page.key]
+    self.size = self.size - len(page.body)
@@ -0,0 +1,150 @@
+#
+# playlist.py -- recursive playlists made from the filename cache of edna
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+import os
+import string
+import urllib
+import threading
+from types import StringType
+
+from filecache import _unpack
+from walker import join
+
+
+class PlaylistCache:
+  """
+  The songs of the directories in a FilenameCache, quoted for URLs, so
+  that the recursive playlists can be put together without listing the
+  directories or quoting the names again.
+
+  The part of a directory is a list of pieces, in the order make_list()
+  goes through the directory: strings with the quoted names of songs
+  that follow each other, each name followed by a newline, and
+  (name, quoted name, cached) tuples for the subdirectories, where
+  'cached' is false for those the FilenameCache doesn't go into
+  (symbolic links).
+
+  A part is kept along with the FilenameCache entry it was made from.
+  The cache replaces the entry of a directory when the directory
+  changes, so the part is current as long as the entry is the same
+  object; nothing ever has to be invalidated.
+  """
+
+  def __init__(self, extensions):
+    self.extensions = extensions
+    self.parts = { }            # (rootname, reldir) -> (entry, part)
+    self.lock = threading.Lock()
+    self.dirs = None            # the FilenameCache.dirs last seen
+    self.hits = self.misses = 0
+
+  def __len__(self):
+    return len(self.parts)
+
+  def part(self, dirs, key):
+    """Return the part of the directory 'key' in 'dirs', the directories
+    of a FilenameCache, or None if the directory isn't there."""
+    entry = dirs.get(key)
+    if entry is None:
+      return None
+    cached = self.parts.get(key)
+    if cached is not None and cached[0] is entry:
+      self.hits = self.hits + 1
+      return cached[1]
+    self.misses = self.misses + 1
+    part = self._make(entry)
+    self.lock.acquire()
+    try:
+      if dirs is not self.dirs:
+        # a refresh replaced the directories; drop the parts of the ones
+        # that are gone or changed
+        for key2, (entry2, part2) in self.parts.items():
+          if dirs.get(key2) is not entry2:
+            del self.parts[key2]
+        self.dirs = dirs
+      self.parts[key] = (entry, part)
+    finally:
+      self.lock.release()
+    return part
+
+  def _make(self, entry):
+    mtime, names, subdirs = entry
+    descended = { }
+    for name in subdirs:
+      descended[name] = None
+    items = [ ]
+    for name in _unpack(names):
+      if name[0] == '.':
+        continue
+      if name[-1] == '/':
+        items.append((name[:-1], 1))
+      else:
+        items.append((name, 0))
+    items.sort()
+
+    part = [ ]
+    songs = [ ]
+    for name, is_dir in items:
+      ext = string.lower(os.path.splitext(name)[1])
+      if self.extensions.has_key(ext):
+        songs.append(urllib.quote(name) + '\n')
+      if is_dir:
+        if songs:
+          part.append(string.join(songs, ''))
+          songs = [ ]
+        part.append((name, urllib.quote(name), descended.has_key(name)))
+    if songs:
+      part.append(string.join(songs, ''))
+    return part
+
+  def write(self, write, dirs, key, prefix, outside):
+    """Write the playlist of the directory 'key' in 'dirs' and of the
+    directories below it, a piece at a time, by calling write().  Each
+    line is the URL of a song: 'prefix', the quoted path of the song
+    relative to the directory, and a newline.
+
+    For a directory which the FilenameCache doesn't go into, or which it
+    doesn't know (yet), outside(path) is called instead; 'path' is
+    relative to the directory 'key', with "/" as separator."""
+    rootname = key[0]
+    part = self.part(dirs, key)
+    if part is None:
+      outside('')
+      return
+    stack = [ (key[1], '', prefix, part, 0) ]
+    while stack:
+      reldir, relpath, prefix, part, i = stack.pop()
+      while i < len(part):
+        piece = part[i]
+        i = i + 1
+        if type(piece) is StringType:
+          write(prefix + string.replace(piece[:-1], '\n', '\n' + prefix)
+                + '\n')
+          continue
+        name, quoted, cached = piece
+        subpath = join(relpath, name)
+        sub = None
+        if cached:
+          sub = self.part(dirs, (rootname, join(reldir, name)))
+        if sub is None:
+          outside(subpath)
+          continue
+        # come back to the rest of this directory afterwards
+        stack.append((reldir, relpath, prefix, part, i))
+        stack.append((join(reldir, name), subpath, prefix + quoted + '/',
+                      sub, 0))
+        break
@@ -33,7 +33,8 @@ class Scheduler(Thread):
   up signal handlers and catching interrupts.
   """
 
-  def __init__(self, offset, interval, action, action_args, sleep_quantum):
+  def __init__(self, offset, interval, action, action_args, sleep_quantum,
+               run_now=1):
     """
     Create and initialize a new scheduler object.  The caller will need to 
     call Thread.start() on it to create a thread to start scheduling actions.
@@ -45,6 +46,7 @@ class Scheduler(Thread):
     between checks for whether the thread has been requested to stop.  This
     is needed because, on some platforms, calls to time.sleep() are not
     interrupted.
+    If 'run_now' is false, the first call is the one at the scheduled time.
     """
     Thread.__init__(self)
     self.offset = int(offset) % (24 * 3600)
@@ -52,6 +54,7 @@ class Scheduler(Thread):
     self.action = action
     self.action_args = action_args
     self.sleep_quantum = sleep_quantum
+    self.run_now = run_now
 
   def run(self):
     """
@@ -59,8 +62,11 @@ class Scheduler(Thread):
     then repetetively thereafter accoding to self.offset and self.interval.
     """
     self.stop_requested = 0
+    run = self.run_now
     while not self.stop_requested:
-      void = apply(self.action, self.action_args)
+      if run:
+        void = apply(self.action, self.action_args)
+      run = 1
       next = self.next_time()
       while time.time() < next and not self.stop_requested:
 	try:
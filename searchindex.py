@@ -0,0 +1,201 @@
+#
+# searchindex.py -- substring search over the filename cache of edna
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+import re
+import string
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+class SearchIndex:
+  """
+  An inverted index from every three-character substring (trigram) of the
+  names in a FilenameCache to the names which contain it.
+
+  The index keeps no names of its own; it refers to those in the cache's
+  name store.  Each directory gets a run of consecutive file ids, one per
+  name, and each file id the offset and length of its name among the
+  names of its directory.  Searching the index builds the
+  (rootname, reldir, name) tuples of FilenameCache.entries() as they are
+  needed.
+
+  A query is split on spaces and an entry qualifies if every word is a
+  (case insensitive) substring of its name -- the same rule as
+  EdnaRequestHandler.filename_qualifies.  Words of three or more
+  characters are resolved by intersecting the posting lists of their
+  trigrams, and the few remaining candidates are checked against the full
+  words.  Only when every word is shorter than that do we have to scan
+  all of the names, which is done with a regular expression over the
+  names of each directory.
+
+  A directory which changed is indexed again as a whole, under new ids
+  (see index_dir()); its old ids are left behind as a hole.  Rebuilding
+  the index gets rid of them.
+  """
+
+  def __init__(self, cache=None):
+    self.dirs = [ ]             # directory id -> (rootname, reldir), or
+                                # None once indexed again or gone
+    self.names = [ ]            # directory id -> the names in it
+    self.dir_ids = { }          # (rootname, reldir) -> directory id
+    self.firsts = array('i')    # directory id -> its first file id
+    self.offsets = array('i')   # file id -> offset of its name
+    self.lengths = array('H')   # file id -> length of its name
+    self.postings = { }         # trigram -> ascending array of file ids
+    self.removed = 0
+    if cache is not None:
+      for key, entry in cache.walk():
+        self.index_dir(key, entry[1])
+
+  def __len__(self):
+    return len(self.offsets) - self.removed
+
+  def __iter__(self):
+    for i in xrange(len(self.offsets)):
+      entry = self._entry(i)
+      if entry is not None:
+        yield entry
+
+  def index_dir(self, key, names):
+    """Index the names of the directory 'key', those of its FilenameCache
+    entry, in place of what was indexed for it before."""
+    self.drop_dir(key)
+    # the directory goes in before its ids, and the ids before they are
+    # published in the postings, so a concurrent search never sees an id
+    # it can't resolve
+    dir_id = len(self.dirs)
+    first = len(self.offsets)
+    self.names.append(names)
+    self.dirs.append(key)
+    self.dir_ids[key] = dir_id
+    self.firsts.append(first)
+
+    offset = 0
+    names = names[:]
+    if names:
+      for name in string.split(names, '\0'):
+        self.offsets.append(offset)
+        self.lengths.append(len(name))
+        offset = offset + len(name) + 1
+
+    postings = self.postings
+    lowered = string.lower(names)
+    for i in xrange(first, len(self.offsets)):
+      start = self.offsets[i]
+      for tri in _trigrams(lowered[start:start + self.lengths[i]]):
+        try:
+          postings[tri].append(i)
+        except KeyError:
+          postings[tri] = array('i', [i])
+
+  def drop_dir(self, key):
+    "Stop finding the names of the directory 'key'."
+    dir_id = self.dir_ids.get(key)
+    if dir_id is None:
+      return
+    del self.dir_ids[key]
+    self.dirs[dir_id] = None
+    self.names[dir_id] = None
+    self.removed = self.removed + self._end(dir_id) - self.firsts[dir_id]
+
+  def search(self, query):
+    # empty words (from repeated spaces) are substrings of anything
+    words = filter(None, map(string.lower, string.split(query, ' ')))
+
+    lists = [ ]
+    for word in words:
+      for tri in _trigrams(word):
+        if not self.postings.has_key(tri):
+          return [ ]
+        lists.append(self.postings[tri])
+    if lists:
+      lists.sort(lambda a, b: cmp(len(a), len(b)))
+      candidates = lists[0]
+      for ids in lists[1:]:
+        candidates = _intersect(candidates, ids)
+    elif words:
+      candidates = self._scan(words[0])
+    else:
+      candidates = xrange(len(self.offsets))
+
+    results = [ ]
+    for i in candidates:
+      entry = self._entry(i)
+      if entry is None:
+        continue
+      name = string.lower(entry[2])
+      for word in words:
+        if string.find(name, word) == -1:
+          break
+      else:
+        results.append(entry)
+    return results
+
+  def _scan(self, word):
+    """Return the ids of the names which contain 'word', by searching the
+    names of each directory at once."""
+    pattern = re.compile(re.escape(word), re.IGNORECASE)
+    offsets = self.offsets
+    ids = [ ]
+    for dir_id in xrange(len(self.firsts)):
+      names = self.names[dir_id]
+      if not names:
+        continue
+      first = self.firsts[dir_id]
+      end = self._end(dir_id)
+      match = pattern.search(names)
+      while match is not None:
+        i = bisect_right(offsets, match.start(), first, end) - 1
+        ids.append(i)
+        if i + 1 >= end:
+          break
+        match = pattern.search(names, offsets[i + 1])
+    return ids
+
+  def _end(self, dir_id):
+    "Return the file id after the last one of the directory 'dir_id'."
+    if dir_id + 1 < len(self.firsts):
+      return self.firsts[dir_id + 1]
+    return len(self.offsets)
+
+  def _entry(self, i):
+    dir_id = bisect_right(self.firsts, i) - 1
+    key = self.dirs[dir_id]
+    names = self.names[dir_id]
+    if key is None or names is None:
+      return None
+    start = self.offsets[i]
+    return key + (names[start:start + self.lengths[i]],)
+
+
+def _trigrams(s):
+  tris = { }
+  for i in xrange(len(s) - 2):
+    tris[s[i:i+3]] = None
+  return tris.keys()
+
+def _intersect(small, big):
+  """Intersect two ascending sequences of ids, the first being the
+  shorter one."""
+  result = [ ]
+  size = len(big)
+  for i in small:
+    j = bisect_left(big, i)
+    if j < size and big[j] == i:
+      result.append(i)
+  return result
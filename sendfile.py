@@ -0,0 +1,65 @@
+#
+# sendfile.py -- copy files to sockets inside the kernel
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""
+A wrapper around the sendfile() system call, which copies data from a
+file to a socket without passing it through user space.  Python doesn't
+provide it, so on Linux it is called through ctypes.  'available' tells
+whether it can be used at all; callers should fall back to reading and
+writing when it isn't, or when sendfile() fails with EINVAL or ENOSYS
+(e.g. for files on filesystems which don't support it).
+"""
+
+import os
+import sys
+
+try:
+  import ctypes
+  import ctypes.util
+except ImportError:
+  ctypes = None
+
+
+def _load():
+  if ctypes is None or not sys.platform.startswith('linux'):
+    return None
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+    func = libc.sendfile64
+  except (OSError, AttributeError):
+    return None
+  func.argtypes = [ctypes.c_int, ctypes.c_int,
+                   ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t]
+  func.restype = ctypes.c_ssize_t
+  return func
+
+_sendfile = _load()
+available = _sendfile is not None
+
+
+def sendfile(out_fd, in_fd, offset, count):
+  """Copy up to 'count' bytes starting at 'offset' in the file 'in_fd' to
+  the socket 'out_fd'.  Returns the number of bytes copied, which is 0 at
+  the end of the file.  Raises OSError on failure."""
+  off = ctypes.c_longlong(offset)
+  sent = _sendfile(out_fd, in_fd, ctypes.byref(off), count)
+  if sent < 0:
+    errno = ctypes.get_errno()
+    raise OSError(errno, os.strerror(errno))
+  return sent
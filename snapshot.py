@@ -0,0 +1,261 @@
+#
+# snapshot.py -- save and restore the filename cache and search index
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""
+A snapshot file holds a FilenameCache and the SearchIndex built from it,
+so that a restarted server can answer searches right away and only has
+to reconcile the cache with the disk (an incremental refresh) in the
+background.
+
+The file starts with a fixed size header: a magic string, the format
+version, a description of the machine (byte order and array item sizes,
+since the arrays are stored in native format) and the sizes of the
+sections that follow.  The first section is a marshalled tuple with the
+small structures: the directories, each with the place of its names in
+the name store, and the directory table of the index.  Then come the
+name store and the raw contents of the index's arrays.  It is read
+through mmap.  A process which changes what it loaded gets copies of the
+arrays; the others (the workers of a pre-forked server) read the names
+and the index straight from the mapped file, so they all share the same
+pages of the page cache.
+"""
+
+import os
+import sys
+import mmap
+import struct
+import marshal
+from array import array
+
+import filecache
+import searchindex
+
+MAGIC = 'edna-snapshot\n\0\0'
+VERSION = 2
+
+# magic, version, machine, then the sizes of the sections
+_HEADER = '<16sI16s5I'
+_HEADER_SIZE = struct.calcsize(_HEADER)
+
+class SnapshotError(Exception):
+  pass
+
+
+def _machine():
+  return '%s %d %d' % (sys.byteorder[0], array('i').itemsize,
+                       array('H').itemsize)
+
+
+def save(fname, cache, index):
+  """Write 'cache' and 'index' to the file 'fname'.  The file is replaced
+  atomically, so a crash can't leave a half written snapshot behind."""
+  postings = index.postings
+  trigrams = postings.keys()
+  sizes = array('i')
+  for tri in trigrams:
+    sizes.append(len(postings[tri]))
+
+  # the names go in a store of their own, without what is out of date;
+  # the index refers to them through the directories
+  dirs = [ ]
+  store = [ ]
+  size = 0
+  for key, (mtime, names, subdirs) in cache.dirs.items():
+    dirs.append((key, mtime, size, len(names), subdirs))
+    store.append(names)
+    size = size + len(names) + 1
+
+  meta = marshal.dumps((cache.roots, dirs, index.dirs, index.removed,
+                        trigrams, sizes.tostring()))
+  arrays = [ index.firsts.tostring(),
+             index.offsets.tostring(),
+             index.lengths.tostring() ]
+
+  tmpname = fname + '.tmp'
+  fp = open(tmpname, 'wb')
+  try:
+    fp.write(struct.pack(_HEADER, MAGIC, VERSION, _machine(), len(meta),
+                         size, *map(len, arrays)))
+    fp.write(meta)
+    for names in store:
+      fp.write(names[:] + '\0')
+    for section in arrays:
+      fp.write(section)
+    # the postings go last, one after the other, in the order of 'trigrams'
+    for tri in trigrams:
+      fp.write(postings[tri].tostring())
+  finally:
+    fp.close()
+  if os.name != 'posix' and os.path.exists(fname):
+    os.remove(fname)
+  os.rename(tmpname, fname)
+
+
+def load(fname, shared=0):
+  """Read a snapshot written by save().  Returns a (FilenameCache,
+  SearchIndex) tuple, or raises SnapshotError if the file doesn't hold a
+  usable snapshot.  If 'shared' is true, the names and the index are read
+  from the mapped file as they are needed, rather than copied; the
+  results must not be changed then."""
+  try:
+    fp = open(fname, 'rb')
+  except IOError, e:
+    raise SnapshotError(str(e))
+  try:
+    try:
+      size = os.fstat(fp.fileno()).st_size
+      if size < _HEADER_SIZE:
+        raise SnapshotError('%s is not a snapshot' % fname)
+      mm = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ)
+    except (EnvironmentError, mmap.error), e:
+      raise SnapshotError(str(e))
+  finally:
+    fp.close()
+
+  try:
+    try:
+      return _read(mm, fname, shared)
+    except (EOFError, ValueError, TypeError, KeyError, struct.error):
+      raise SnapshotError('%s is damaged' % fname)
+  finally:
+    # what was read from a shared mapping keeps it open as long as it's
+    # in use
+    if not shared:
+      mm.close()
+
+
+def _read(mm, fname, shared):
+  header = struct.unpack(_HEADER, mm[:_HEADER_SIZE])
+  magic, version, machine = header[:3]
+  if magic != MAGIC:
+    raise SnapshotError('%s is not a snapshot' % fname)
+  if version != VERSION or machine.rstrip('\0') != _machine():
+    raise SnapshotError('%s was written by another version or machine'
+                        % fname)
+
+  pos = _HEADER_SIZE
+  places = [ ]
+  for length in header[3:]:
+    places.append((pos, length))
+    pos = pos + length
+  if pos > len(mm):
+    raise SnapshotError('%s is damaged' % fname)
+  start, length = places[0]
+  roots, dirs, index_dirs, removed, trigrams, sizes \
+    = marshal.loads(mm[start:start + length])
+
+  cache = filecache.FilenameCache()
+  cache.roots = roots
+  if shared:
+    store, base = mm, places[1][0]
+  else:
+    store, base = cache.store, 0
+    start, length = places[1]
+    store.fromstring(mm[start:start + length])
+  for key, mtime, start, length, subdirs in dirs:
+    if start + length > places[1][1]:
+      raise SnapshotError('%s is damaged' % fname)
+    cache.dirs[key] = (mtime, buffer(store, base + start, length), subdirs)
+
+  index = searchindex.SearchIndex()
+  index.dirs = index_dirs
+  for i in xrange(len(index_dirs)):
+    key = index_dirs[i]
+    if key is None:
+      index.names.append(None)
+    else:
+      index.dir_ids[key] = i
+      index.names.append(cache.dirs[key][1])
+  index.removed = removed
+  sizes = array('i', sizes)
+  arrays = [ index.firsts, index.offsets, index.lengths ]
+  if shared:
+    for i in range(len(arrays)):
+      start, length = places[i + 2]
+      arrays[i] = _Array(mm, start, length, arrays[i].typecode)
+    index.firsts, index.offsets, index.lengths = arrays
+    index.postings = _Postings(mm, pos, trigrams, sizes)
+    pos = index.postings.end
+  else:
+    for i in range(len(arrays)):
+      start, length = places[i + 2]
+      arrays[i].fromstring(mm[start:start + length])
+    itemsize = sizes.itemsize
+    postings = index.postings
+    for i in xrange(len(trigrams)):
+      length = sizes[i] * itemsize
+      postings[trigrams[i]] = array('i', mm[pos:pos + length])
+      pos = pos + length
+  if pos != len(mm) or len(index.lengths) != len(index.offsets) \
+     or len(index.firsts) != len(index_dirs):
+    raise SnapshotError('%s is damaged' % fname)
+
+  return cache, index
+
+
+class _Array:
+  """The items of an array in a mapped snapshot, as a read-only sequence.
+  They are unpacked from the file as they are asked for."""
+
+  def __init__(self, mm, start, length, typecode):
+    self.mm = mm
+    self.start = start
+    self.format = typecode
+    self.itemsize = struct.calcsize(typecode)
+    if length % self.itemsize:
+      raise ValueError('partial array item')
+    self.count = length / self.itemsize
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, i):
+    if i < 0:
+      i = i + self.count
+    if i < 0 or i >= self.count:
+      raise IndexError(i)
+    return struct.unpack_from(self.format, self.mm,
+                              self.start + i * self.itemsize)[0]
+
+
+class _Postings:
+  """The posting lists in a mapped snapshot, in place of the dictionary
+  of SearchIndex.postings.  Each list is read from the file when it is
+  looked up."""
+
+  def __init__(self, mm, start, trigrams, sizes):
+    self.mm = mm
+    self.lists = { }          # trigram -> its number in 'trigrams'
+    self.starts = array('l')  # its number -> where its list starts
+    self.sizes = sizes        # its number -> the length of its list
+    for i in xrange(len(trigrams)):
+      self.lists[trigrams[i]] = i
+      self.starts.append(start)
+      start = start + sizes[i] * sizes.itemsize
+    self.end = start
+
+  def has_key(self, tri):
+    return self.lists.has_key(tri)
+
+  def keys(self):
+    return self.lists.keys()
+
+  def __getitem__(self, tri):
+    i = self.lists[tri]
+    return _Array(self.mm, self.starts[i], self.sizes[i] * self.sizes.itemsize,
+                  'i')
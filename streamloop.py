@@ -0,0 +1,242 @@
+#
+# streamloop.py -- send many file bodies from one thread
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+import os
+import errno
+import Queue
+import select
+import socket
+import threading
+from threading import Thread
+
+# how much is read from a file at a time, and sent to one client before
+# moving on to the next
+CHUNK = 65536
+
+# how many threads read the files for the loop
+READERS = 4
+
+available = hasattr(select, 'epoll') or hasattr(select, 'poll')
+
+
+class StreamLoop(Thread):
+  """
+  A thread which sends the rest of a response -- a part of a file -- to
+  any number of clients, using non-blocking sockets and epoll (or poll).
+  Most clients are players that take a song at the rate it plays, so
+  each of them needs attention only now and then; handing them to the
+  loop frees the request handler's thread right after the headers.
+
+  The loop itself never touches the disk, so that one slow read (of a
+  file on NFS, say) can't hold up every stream.  'readers' threads read
+  the files, a CHUNK at a time, and hand each chunk back through the
+  wakeup pipe; a client is left alone until its next chunk is there.
+
+  add() may be called from any thread.  The loop owns the socket and the
+  file from then on and closes both when the body has been sent, or when
+  the client goes away.  stop() makes the loop exit once the bodies it
+  is sending are done.
+  """
+
+  def __init__(self, log, sleep_quantum=10, readers=READERS):
+    Thread.__init__(self)
+    self.setDaemon(1)
+    self.log = log
+    self.sleep_quantum = sleep_quantum
+    self.readers = max(1, readers)
+    self.stop_requested = 0
+    self.streams = { }      # fd -> _Stream
+    self.pending = [ ]      # added, but not yet registered
+    self.read = [ ]         # streams whose next chunk the readers read
+    self.to_read = Queue.Queue()
+    self.lock = threading.Lock()
+    # written to by add() and stop() to wake up the loop
+    self.wake_r, self.wake_w = os.pipe()
+
+  def add(self, sock, f, offset, count):
+    """Send 'count' bytes of the file 'f', from 'offset' on, to 'sock'."""
+    sock.setblocking(0)
+    self.lock.acquire()
+    try:
+      self.pending.append(_Stream(sock, f, offset, count))
+    finally:
+      self.lock.release()
+    self._wake()
+
+  def owns(self, sock):
+    """Return true if the loop (still) sends to 'sock'."""
+    self.lock.acquire()
+    try:
+      for stream in self.pending:
+        if stream.sock is sock:
+          return 1
+      for stream in self.streams.values():
+        if stream.sock is sock:
+          return 1
+      return 0
+    finally:
+      self.lock.release()
+
+  def __len__(self):
+    return len(self.streams) + len(self.pending)
+
+  def stop(self):
+    self.stop_requested = 1
+    self._wake()
+
+  def _wake(self):
+    try:
+      os.write(self.wake_w, 'x')
+    except OSError:
+      pass
+
+  def _reader(self):
+    while 1:
+      stream = self.to_read.get()
+      if stream is None:
+        return
+      stream.read()
+      self.lock.acquire()
+      try:
+        self.read.append(stream)
+      finally:
+        self.lock.release()
+      self._wake()
+
+  def run(self):
+    if hasattr(select, 'epoll'):
+      poller = select.epoll()
+      POLLIN, POLLOUT, scale = select.EPOLLIN, select.EPOLLOUT, 1
+    else:
+      poller = select.poll()
+      POLLIN, POLLOUT, scale = select.POLLIN, select.POLLOUT, 1000
+    poller.register(self.wake_r, POLLIN)
+    for i in range(self.readers):
+      t = Thread(target=self._reader)
+      t.setDaemon(1)
+      t.start()
+    try:
+      while 1:
+        self.lock.acquire()
+        try:
+          pending, self.pending = self.pending, [ ]
+          read, self.read = self.read, [ ]
+          for stream in pending:
+            self.streams[stream.sock.fileno()] = stream
+        finally:
+          self.lock.release()
+        for stream in pending:
+          self.to_read.put(stream)
+        for stream in read:
+          fd = stream.sock.fileno()
+          if stream.error is not None:
+            self.log("edna: error while streaming: %s" % stream.error)
+          if stream.buf:
+            poller.register(fd, POLLOUT)
+          else:
+            # the end of the file (or it shrank, or can't be read)
+            self._finish(fd, stream)
+        if self.stop_requested and not self.streams:
+          break
+
+        try:
+          events = poller.poll(self.sleep_quantum * scale)
+        except (select.error, IOError), e:
+          if e[0] == errno.EINTR:
+            continue
+          raise
+        for fd, event in events:
+          if fd == self.wake_r:
+            os.read(self.wake_r, 4096)
+            continue
+          stream = self.streams.get(fd)
+          if stream is None:
+            continue
+          try:
+            stream.send()
+          except socket.error, e:
+            if e[0] != errno.EPIPE and e[0] != errno.ECONNRESET:
+              self.log("edna: error while streaming: %s" % e)
+            poller.unregister(fd)
+            self._finish(fd, stream)
+            continue
+          if not stream.buf:
+            # nothing to send until the next chunk has been read
+            poller.unregister(fd)
+            if stream.count <= 0:
+              self._finish(fd, stream)
+            else:
+              self.to_read.put(stream)
+    finally:
+      for i in range(self.readers):
+        self.to_read.put(None)
+      for stream in self.streams.values():
+        stream.close()
+      poller.close()
+      os.close(self.wake_r)
+      os.close(self.wake_w)
+
+  def _finish(self, fd, stream):
+    self.lock.acquire()
+    try:
+      del self.streams[fd]
+    finally:
+      self.lock.release()
+    stream.close()
+
+
+class _Stream:
+  def __init__(self, sock, f, offset, count):
+    self.sock = sock
+    self.f = f
+    self.offset = offset    # of the next chunk to read
+    self.count = count      # bytes left to read
+    self.buf = ''           # read, not sent yet
+    self.error = None
+
+  def read(self):
+    """Read the next chunk into 'buf' (in a reader thread).  It is left
+    empty at the end of the file, and if the file can't be read, with
+    the error in 'error'."""
+    try:
+      self.f.seek(self.offset)
+      self.buf = self.f.read(min(self.count, CHUNK))
+    except (EnvironmentError, ValueError), e:
+      self.buf = ''
+      self.error = e
+    self.offset = self.offset + len(self.buf)
+    self.count = self.count - len(self.buf)
+
+  def send(self):
+    "Send as much of 'buf' as the socket takes."
+    try:
+      sent = self.sock.send(self.buf)
+    except socket.error, e:
+      if e[0] == errno.EAGAIN or e[0] == errno.EWOULDBLOCK \
+         or e[0] == errno.EINTR:
+        return
+      raise
+    self.buf = self.buf[sent:]
+
+  def close(self):
+    self.f.close()
+    try:
+      self.sock.shutdown(socket.SHUT_WR)
+    except socket.error:
+      pass
+    self.sock.close()
@@ -0,0 +1,98 @@
+#
+# threadpool.py -- handle the requests of a SocketServer in a pool of threads
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+import Queue
+import SocketServer
+from threading import Thread
+
+
+class ThreadPoolMixIn(SocketServer.ThreadingMixIn):
+  """
+  Mix-in class for a SocketServer which hands the accepted connections to
+  a fixed number of worker threads, through a queue.  When 'pool_queue_size'
+  connections are already waiting for a worker, new ones are passed to
+  reject_request() instead, which should tell the client to come back
+  later.
+
+  start_pool() has to be called once the server is set up; until it is
+  (or if 'pool_threads' is 0) every connection gets a thread of its own,
+  as with ThreadingMixIn.  stop_pool() lets the workers finish the
+  connections which are already queued, then exit.
+  """
+
+  pool_threads = 16
+  pool_queue_size = 64
+  pool_queue = None
+  daemon_threads = 1
+
+  def start_pool(self):
+    if self.pool_threads <= 0:
+      return
+    # not bounded by Queue itself, so that stop_pool() never blocks; only
+    # process_request() adds connections, and it checks the size first
+    self.pool_queue = Queue.Queue()
+    for i in range(self.pool_threads):
+      t = Thread(target=self.pool_worker)
+      t.setDaemon(1)
+      t.start()
+
+  def stop_pool(self):
+    queue = self.pool_queue
+    if queue is None:
+      return
+    self.pool_queue = None
+    for i in range(self.pool_threads):
+      queue.put(None)
+
+  def pool_busy(self):
+    """Return true if connections are waiting for a worker."""
+    queue = self.pool_queue
+    return queue is not None and queue.qsize() > 0
+
+  def process_request(self, request, client_address):
+    queue = self.pool_queue
+    if queue is None:
+      SocketServer.ThreadingMixIn.process_request(self, request,
+                                                  client_address)
+    elif queue.qsize() >= self.pool_queue_size:
+      try:
+        self.reject_request(request, client_address)
+      finally:
+        self.shutdown_request(request)
+    else:
+      queue.put((request, client_address))
+
+  def reject_request(self, request, client_address):
+    """Called for a connection which can't be queued; override it to send
+    an error to the client.  The connection is closed afterwards."""
+    pass
+
+  def pool_worker(self):
+    queue = self.pool_queue
+    while 1:
+      item = queue.get()
+      if item is None:
+        return
+      request, client_address = item
+      # the same as ThreadingMixIn.process_request_thread
+      try:
+        self.finish_request(request, client_address)
+        self.shutdown_request(request)
+      except:
+        self.handle_error(request, client_address)
+        self.shutdown_request(request)
@@ -0,0 +1,146 @@
+#
+# walker.py -- walk the directory trees of edna
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+import os
+import stat
+import string
+
+# how many levels below its top a walk goes at most, and how many
+# directory entries it lists at most (0 for no limit), unless a Walker
+# is given others
+MAX_DEPTH = 64
+MAX_ENTRIES = 0
+
+
+class Walker:
+  """
+  Walks a directory tree top-down, with a stack of the directories still
+  to be listed instead of recursion, so a deep tree can't run into
+  Python's recursion limit.
+
+  Each directory is gone into at most once per walk, going by its
+  (st_dev, st_ino): a symbolic link or a mount leading back up the tree
+  is skipped instead of being walked round and round.  The walk doesn't
+  go more than 'max_depth' levels below its top, and stops once it has
+  listed 'max_entries' entries (if not 0).  A directory which can't be
+  listed is skipped, and the rest of the walk goes on.
+
+  Skipped directories are reported to log(), if given, and counted in
+  'skipped'; 'truncated' is set when the entry limit stopped a walk.
+  """
+
+  def __init__(self, max_depth=None, max_entries=None, log=None):
+    if max_depth is None:
+      max_depth = MAX_DEPTH
+    if max_entries is None:
+      max_entries = MAX_ENTRIES
+    self.max_depth = max_depth
+    self.max_entries = max_entries
+    self.log = log
+    self.entries = 0
+    self.skipped = 0
+    self.truncated = 0
+
+  def walk(self, top, listdir, reldir=''):
+    """Generate (path, reldir, st, listing) for the directory 'top' and
+    each directory below it.  'reldir' is the path of a directory from
+    the top, with "/" as separator; a walk starting below the top of a
+    tree may pass its own, and is limited in depth from there.
+
+    listdir(path, reldir, st) lists a directory, given its os.stat()
+    result, and returns a (listing, subdirs, count) tuple: what to
+    generate for the directory, the names of the subdirectories to walk,
+    in order, and the number of entries it listed."""
+    visited = { }
+    if reldir:
+      depth = string.count(reldir, '/') + 1
+    else:
+      depth = 0
+    stack = [ (top, reldir, depth) ]
+    while stack:
+      if self.max_entries and self.entries >= self.max_entries:
+        self.truncated = 1
+        self._skip(top, 'stopped after %d entries' % self.entries)
+        return
+      path, reldir, depth = stack.pop()
+      try:
+        st = os.stat(path)
+      except OSError, e:
+        self._skip(path, e.strerror)
+        continue
+      # st_ino is always 0 on some platforms (Windows); nothing to go by
+      if st.st_ino:
+        ident = (st.st_dev, st.st_ino)
+        if visited.has_key(ident):
+          self._skip(path, 'already walked (a loop?)')
+          continue
+        visited[ident] = None
+      try:
+        listing, subdirs, count = listdir(path, reldir, st)
+      except EnvironmentError, e:
+        self._skip(path, e.strerror or str(e))
+        continue
+      self.entries = self.entries + count
+      yield path, reldir, st, listing
+
+      if not subdirs:
+        continue
+      if depth >= self.max_depth:
+        self._skip(path, 'subdirectories more than %d levels deep'
+                   % self.max_depth)
+        continue
+      subdirs = list(subdirs)
+      subdirs.reverse()
+      for name in subdirs:
+        stack.append((os.path.join(path, name), join(reldir, name),
+                      depth + 1))
+
+  def _skip(self, path, reason):
+    self.skipped = self.skipped + 1
+    if self.log is not None:
+      self.log('edna: skipping %s: %s' % (path, reason))
+
+
+def list_dir(path):
+  """List the directory 'path'.  Returns a (name, mode, is_link) tuple
+  for each entry, sorted by name, where 'mode' is the st_mode of what the
+  entry is (following symbolic links), or None if it can't be stat()ed."""
+  listing = [ ]
+  names = os.listdir(path)
+  names.sort()
+  for name in names:
+    fullname = os.path.join(path, name)
+    is_link = 0
+    try:
+      mode = os.lstat(fullname)[stat.ST_MODE]
+      if stat.S_ISLNK(mode):
+        is_link = 1
+        mode = os.stat(fullname)[stat.ST_MODE]
+    except OSError:
+      mode = None
+    listing.append((name, mode, is_link))
+  return listing
+
+def is_dir(mode):
+  return mode is not None and stat.S_ISDIR(mode)
+
+def join(reldir, name):
+  """Append 'name' to the relative path 'reldir', with "/" as separator."""
+  if reldir:
+    return reldir + '/' + name
+  return name
@@ -0,0 +1,235 @@
+#
+# watcher.py -- notice changes to the directories in the filename cache
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+import os
+import sys
+import time
+import errno
+import struct
+import select
+from threading import Thread
+
+try:
+  import ctypes
+  import ctypes.util
+except ImportError:
+  ctypes = None
+
+# from <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+
+_WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO \
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+_EVENT_HEADER = 'iIII'
+_EVENT_HEADER_SIZE = struct.calcsize(_EVENT_HEADER)
+
+
+class Watcher(Thread):
+  """
+  A thread which watches the directories of a FilenameCache and calls
+  changed(rootname, reldir) for each one whose contents changed.  The
+  callback is expected to bring the cache up to date and to return what
+  FilenameCache.update() returns: the entries added and removed.
+
+  This base class polls: every 'interval' seconds it stat()s every
+  directory in the cache and compares its mtime.  Use make_watcher() to
+  get the best watcher for the platform.
+  """
+
+  def __init__(self, cache, changed, interval, sleep_quantum=10):
+    Thread.__init__(self)
+    self.setDaemon(1)
+    self.cache = cache
+    self.changed = changed
+    self.interval = interval
+    self.sleep_quantum = sleep_quantum
+    self.stop_requested = 0
+
+  def run(self):
+    while not self.stop_requested:
+      next = time.time() + self.interval
+      while time.time() < next and not self.stop_requested:
+        time.sleep(min(self.sleep_quantum, next - time.time()))
+      if not self.stop_requested:
+        self.check_all()
+
+  def stop(self):
+    self.stop_requested = 1
+
+  def check_all(self):
+    """Look for changed directories by comparing mtimes."""
+    cache = self.cache
+    for key, (mtime, names, subdirs) in cache.dirs.items():
+      if self.stop_requested:
+        return
+      try:
+        current = os.stat(cache.path(key[0], key[1])).st_mtime
+      except (OSError, KeyError):
+        continue
+      if mtime is None or mtime != current:
+        self.changed(key[0], key[1])
+
+
+class InotifyWatcher(Watcher):
+  """
+  A Watcher using Linux's inotify, so that changes are applied as soon as
+  they happen and nothing is done while nothing changes.  Directories
+  that can't be watched (e.g. beyond fs.inotify.max_user_watches) are only
+  picked up by the scheduled refreshes of the filename cache.
+
+  The watch of a directory that is deleted goes away by itself.  A
+  directory that is moved keeps its watch: right if it was moved within
+  the tree (watching it at its new place gets the same watch), but if the
+  cache forgot it, its watch and those below it are removed.
+  """
+
+  def __init__(self, cache, changed, log, sleep_quantum=10):
+    Watcher.__init__(self, cache, changed, 0, sleep_quantum)
+    self.log = log
+    self.fd = _libc.inotify_init()
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init')
+    self.watches = { }    # wd -> (rootname, reldir)
+    self.generation = None
+    self.full = 0
+
+  def run(self):
+    try:
+      while not self.stop_requested:
+        if self.generation != self.cache.generation:
+          # the cache was refreshed; it may have found new directories
+          self.generation = self.cache.generation
+          for key in self.cache.dirs.keys():
+            self.watch(key)
+        try:
+          ready = select.select([self.fd], [], [], self.sleep_quantum)[0]
+        except select.error, e:
+          if e[0] == errno.EINTR:
+            continue
+          raise
+        if ready:
+          self.process(os.read(self.fd, 65536))
+    finally:
+      os.close(self.fd)
+
+  def watch(self, key):
+    try:
+      path = self.cache.path(key[0], key[1])
+    except KeyError:
+      return
+    wd = _libc.inotify_add_watch(self.fd, path, _WATCH_MASK)
+    if wd >= 0:
+      self.watches[wd] = key
+    elif ctypes.get_errno() == errno.ENOSPC and not self.full:
+      self.full = 1
+      self.log("WARNING: edna: out of inotify watches (see "
+               "/proc/sys/fs/inotify/max_user_watches), some directories "
+               "are only updated by the filename cache refresh")
+
+  def unwatch(self, key):
+    """Stop watching the directory 'key' and those below it."""
+    rootname, reldir = key
+    prefix = reldir + '/'
+    for wd, (rootname2, reldir2) in self.watches.items():
+      if rootname2 == rootname and (reldir2 == reldir or not reldir or
+                                    reldir2[:len(prefix)] == prefix):
+        del self.watches[wd]
+        _libc.inotify_rm_watch(self.fd, wd)
+
+  def process(self, data):
+    changed = [ ]
+    moved = [ ]
+    overflow = 0
+    i = 0
+    while i + _EVENT_HEADER_SIZE <= len(data):
+      wd, mask, cookie, length = struct.unpack(_EVENT_HEADER,
+                                               data[i:i+_EVENT_HEADER_SIZE])
+      i = i + _EVENT_HEADER_SIZE + length
+      if mask & IN_Q_OVERFLOW:
+        overflow = 1
+      elif mask & (IN_IGNORED | IN_DELETE_SELF):
+        # the directory is gone
+        if self.watches.has_key(wd):
+          del self.watches[wd]
+      elif mask & IN_MOVE_SELF:
+        # sorted out once its old and new parents have been updated
+        if self.watches.has_key(wd):
+          moved.append(wd)
+      elif self.watches.has_key(wd) and not self.watches[wd] in changed:
+        changed.append(self.watches[wd])
+
+    if overflow:
+      self.check_all()
+    else:
+      self.apply(changed)
+    for wd in moved:
+      key = self.watches.get(wd)
+      if key is not None and not self.cache.dirs.has_key(key):
+        # moved out of the tree; its watch would report its changes under
+        # the path it used to have
+        self.unwatch(key)
+
+  def apply(self, changed):
+    while changed:
+      rootname, reldir = changed.pop(0)
+      added, removed = self.changed(rootname, reldir)
+      for rootname, reldir, name in added:
+        key = (rootname, reldir and reldir + '/' + name[:-1] or name[:-1])
+        if name[-1:] == '/' and self.cache.dirs.has_key(key):
+          # watch the new directory, then look at it again in case
+          # something was added to it before the watch was in place
+          self.watch(key)
+          changed.append(key)
+
+
+def make_watcher(cache, changed, interval, log):
+  """Return an InotifyWatcher if the platform has inotify, otherwise a
+  Watcher polling every 'interval' seconds."""
+  if _libc is not None:
+    try:
+      return InotifyWatcher(cache, changed, log)
+    except OSError, e:
+      log("edna: inotify is not available (%s), polling for changes"
+          % os.strerror(e.errno))
+  return Watcher(cache, changed, interval)
+
+
+def _load_libc():
+  if ctypes is None or not sys.platform.startswith('linux'):
+    return None
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+    libc.inotify_init
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                       ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+  except (OSError, AttributeError):
+    return None
+  return libc
+
+_libc = _load_libc()
@@ -0,0 +1,260 @@
+#
+# zipstream.py -- ZIP archives produced as they are sent
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""
+Songs are already compressed, so the archives edna serves store the files
+as they are (the ZIP "stored" method).  That makes the size of an archive
+a matter of adding up the sizes of the files and of the headers, and the
+archive can be produced piece by piece while it is sent, instead of being
+built in memory first.
+
+See the ZIP file format specification (APPNOTE.TXT) for the records
+written here.  Archives are limited to 4 GB and 65535 files; there is no
+ZIP64 support.
+"""
+
+import os
+import string
+import time
+import struct
+import zlib
+
+# the largest archive that can be written without ZIP64 extensions
+MAX_SIZE = 0xffffffffL
+MAX_FILES = 0xffff
+
+_LOCAL = '<4s5H3L2H'            # local file header
+_DESCRIPTOR = '<4s3L'           # data descriptor
+_CENTRAL = '<4s6H3L5H2L'        # central directory file header
+_END = '<4s4H2LH'               # end of central directory record
+
+_LOCAL_SIZE = struct.calcsize(_LOCAL)
+_DESCRIPTOR_SIZE = struct.calcsize(_DESCRIPTOR)
+_CENTRAL_SIZE = struct.calcsize(_CENTRAL)
+_END_SIZE = struct.calcsize(_END)
+
+# general purpose flag: the CRC follows the data, in a data descriptor
+_FLAG_DESCRIPTOR = 0x08
+
+# how much of a file checksum() reads at a time
+_CHUNK_SIZE = 65536
+
+# kinds of pieces an archive is made of
+_HEADER, _DATA, _TRAILER, _DIRECTORY = range(4)
+
+
+class ZipError(Exception):
+  pass
+
+
+class _Entry:
+  def __init__(self, path, name, size, mtime, crc):
+    self.path = path
+    self.name = name
+    self.size = size
+    self.mtime = mtime
+    self.crc = crc
+    self.descriptor = crc is None
+    t = time.localtime(mtime)
+    if t[0] < 1980:
+      t = (1980, 1, 1, 0, 0, 0)
+    self.dostime = (t[3] << 11) | (t[4] << 5) | (t[5] / 2)
+    self.dosdate = ((t[0] - 1980) << 9) | (t[1] << 5) | t[2]
+    self.offset = 0             # of the local header in the archive
+
+  def flags(self):
+    if self.descriptor:
+      return _FLAG_DESCRIPTOR
+    return 0
+
+  def header(self):
+    # the sizes are known even when the CRC isn't; putting them in lets
+    # readers which don't look at the central directory find the end of
+    # the data
+    return struct.pack(_LOCAL, 'PK\003\004', 10, self.flags(), 0,
+                       self.dostime, self.dosdate, self.crc or 0,
+                       self.size, self.size, len(self.name), 0) + self.name
+
+  def trailer(self):
+    return struct.pack(_DESCRIPTOR, 'PK\007\010', self.crc, self.size,
+                       self.size)
+
+  def central(self):
+    return struct.pack(_CENTRAL, 'PK\001\002', 20, 10, self.flags(), 0,
+                       self.dostime, self.dosdate, self.crc, self.size,
+                       self.size, len(self.name), 0, 0, 0, 0, 0,
+                       self.offset) + self.name
+
+
+class ZipStream:
+  """
+  A ZIP archive of files on disk, with the read() and seek() of a file
+  object, so that it can be sent like a file.  'entries' is a list of
+  (path, name in the archive, size, mtime, crc) tuples, where crc may be
+  None if it isn't known; 'size' is the size of the whole archive, and
+  'mtime' the latest mtime of the files.
+
+  The CRC of a file goes in its local header, in front of the data.  If
+  it isn't known, it is computed while the file is read, and put in a
+  data descriptor after the data.  Such an archive has to be read from
+  start to end; if all the CRCs are known (see checksum()), reading may
+  start anywhere, e.g. to send a byte range.
+
+  A file whose size or mtime changed since it was listed makes read()
+  raise ZipError, since the archive can't be what was promised anymore;
+  'changed' is then the path of the file.
+  """
+
+  def __init__(self, entries):
+    if len(entries) > MAX_FILES:
+      raise ZipError('too many files for a ZIP archive')
+    self.entries = [ ]
+    self.pieces = [ ]           # (kind, offset, length, entry)
+    self.seekable = 1
+    self.mtime = 0
+    offset = 0
+    for path, name, size, mtime, crc in entries:
+      entry = _Entry(path, name, size, mtime, crc)
+      self.mtime = max(self.mtime, mtime)
+      entry.offset = offset
+      self.entries.append(entry)
+      header = _LOCAL_SIZE + len(name)
+      self.pieces.append((_HEADER, offset, header, entry))
+      offset = offset + header
+      self.pieces.append((_DATA, offset, size, entry))
+      offset = offset + size
+      if entry.descriptor:
+        self.seekable = 0
+        self.pieces.append((_TRAILER, offset, _DESCRIPTOR_SIZE, entry))
+        offset = offset + _DESCRIPTOR_SIZE
+    self.directory_offset = offset
+    length = _END_SIZE
+    for entry in self.entries:
+      length = length + _CENTRAL_SIZE + len(entry.name)
+    self.pieces.append((_DIRECTORY, offset, length, None))
+    self.size = offset + length
+    if self.size > MAX_SIZE:
+      raise ZipError('too big for a ZIP archive')
+
+    self.pos = 0
+    self.index = 0              # of the piece 'pos' is in
+    self.f = None               # the file being read, and its entry
+    self.f_entry = None
+    self.crc = 0                # running CRC of that file
+    self.directory = None       # built once the CRCs are all known
+    self.changed = None
+
+  def seek(self, pos):
+    if pos == self.pos:
+      return
+    if not self.seekable:
+      raise ZipError('the archive can only be read from the start')
+    self.close()
+    self.pos = pos
+    self.index = 0
+    while self.index < len(self.pieces) - 1 \
+          and self.pieces[self.index + 1][1] <= pos:
+      self.index = self.index + 1
+
+  def tell(self):
+    return self.pos
+
+  def read(self, size):
+    chunks = [ ]
+    while size > 0 and self.index < len(self.pieces):
+      kind, offset, length, entry = self.pieces[self.index]
+      skip = self.pos - offset
+      count = min(size, length - skip)
+      if kind == _DATA:
+        data = self._read_data(entry, skip, count)
+      else:
+        if kind == _HEADER:
+          data = entry.header()
+        elif kind == _TRAILER:
+          data = entry.trailer()
+        else:
+          data = self._directory()
+        data = data[skip:skip + count]
+      chunks.append(data)
+      self.pos = self.pos + count
+      size = size - count
+      if skip + count == length:
+        self.index = self.index + 1
+    return string.join(chunks, '')
+
+  def close(self):
+    if self.f is not None:
+      self.f.close()
+      self.f = None
+      self.f_entry = None
+
+  def _read_data(self, entry, skip, count):
+    if self.f_entry is not entry:
+      self.close()
+      self.f = open(entry.path, 'rb')
+      self.f_entry = entry
+      self.crc = 0
+      st = os.fstat(self.f.fileno())
+      if st.st_size != entry.size or st.st_mtime != entry.mtime:
+        self.changed = entry.path
+        raise ZipError('%s changed since it was listed' % entry.path)
+    if skip:
+      self.f.seek(skip)
+    data = self.f.read(count)
+    if len(data) < count:
+      self.changed = entry.path
+      raise ZipError('%s changed while it was being read' % entry.path)
+    if entry.descriptor:
+      self.crc = zlib.crc32(data, self.crc)
+    if skip + count == entry.size:
+      if entry.descriptor:
+        entry.crc = self.crc & 0xffffffffL
+      self.close()
+    return data
+
+  def _directory(self):
+    if self.directory is None:
+      records = [ ]
+      for entry in self.entries:
+        records.append(entry.central())
+      length = 0
+      for record in records:
+        length = length + len(record)
+      records.append(struct.pack(_END, 'PK\005\006', 0, 0,
+                                 len(self.entries), len(self.entries),
+                                 length, self.directory_offset, 0))
+      self.directory = string.join(records, '')
+    return self.directory
+
+
+def checksum(path):
+  """Read the file 'path' and return its (size, mtime, crc), for an
+  archive whose CRCs are known in advance."""
+  f = open(path, 'rb')
+  try:
+    mtime = os.fstat(f.fileno()).st_mtime
+    size = crc = 0
+    while 1:
+      data = f.read(_CHUNK_SIZE)
+      if not data:
+        break
+      size = size + len(data)
+      crc = zlib.crc32(data, crc)
+  finally:
+    f.close()
+  return size, mtime, crc & 0xffffffffL